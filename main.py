@@ -1,3 +1,12 @@
+import os
+
+# Giới hạn BLAS/OpenMP mỗi process về 1 thread TRƯỚC khi import numpy/librosa
+# (qua processor). Mỗi mix worker đã chạy song song sẵn; để mặc định mỗi lib
+# lại fan-out nproc thread nữa sẽ oversubscribe CPU và thrash cache.
+# Chỉ set khi deploy chưa cấu hình riêng.
+for _env_key in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+    os.environ.setdefault(_env_key, "1")
+
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form, Request
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,8 +15,6 @@ import os
 import tempfile
 import zipfile
 import logging
-import base64
-import json
 import mimetypes
 import urllib.parse
 import urllib.request
@@ -18,7 +25,7 @@ from functools import lru_cache
 from typing import List, Dict, Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
 # Only v1 pipeline is exposed via API.
-from processor import mix_audio_v1, adjust_bpm, preprocess_shared
+from processor import mix_audio_v1, adjust_bpm, adjust_bpm_batch, preprocess_shared, warmup_analysis
 
 # Task status constants
 TASK_STATUS_PROCESSING = "PROCESSING"
@@ -45,12 +52,35 @@ logger.info(f"Logging level: {log_level}")
 # In-memory task store for background mix tasks (simple dict, NOT for multi-worker)
 # Limit: 2 concurrent tasks for Xeon 4 cores / 8GB RAM
 import uuid
+import queue
 import threading
 from datetime import datetime, timedelta
 
 mixing_tasks: Dict[str, Dict] = {}
 MAX_BACKGROUND_TASKS = 2  # Limit concurrent background tasks (2 per 4 cores)
 
+# Pool cố định cho các mix task nền, thay vì spawn threading.Thread mỗi request.
+# Dùng thread (không phải process) vì pipeline chủ yếu là subprocess FFmpeg
+# (nhả GIL) và worker phải cập nhật trực tiếp mixing_tasks dict in-memory.
+MIX_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_BACKGROUND_TASKS,
+    thread_name_prefix="mix-worker",
+)
+
+# Semaphore giữ chỗ cho task mix: acquire (non-blocking) ngay khi nhận request,
+# release khi task nền kết thúc. Khác với đếm dict (check-then-act, có race khi
+# nhiều request đến cùng lúc), semaphore đảm bảo không bao giờ nhận quá
+# MAX_BACKGROUND_TASKS task đang xử lý.
+MIX_TASK_SLOTS = threading.BoundedSemaphore(MAX_BACKGROUND_TASKS)
+
+
+def _release_mix_slot() -> None:
+    """Trả lại một chỗ mix; bỏ qua nếu release thừa (BoundedSemaphore sẽ raise)."""
+    try:
+        MIX_TASK_SLOTS.release()
+    except ValueError:
+        pass
+
 
 def load_local_env_file() -> None:
     """Nạp các biến môi trường từ file .env khi chạy local hoặc trong Docker.
@@ -113,6 +143,10 @@ R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY", "").strip()
 R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID", "").strip()
 R2_S3_ENDPOINT = os.getenv("R2_S3_ENDPOINT", "").strip()
 ALLOWED_TRACK_EXTENSIONS = {".mp3", ".wav", ".m4a", ".flac"}
+# Khối copy 4MB cho upload nhiều MB: ít syscall hơn hẳn buffer 16KB mặc định.
+UPLOAD_COPY_CHUNK_BYTES = 1 << 22
+# Khối 1MB khi proxy/tải track từ R2: ít lần wake-up event loop hơn khối 256KB.
+R2_STREAM_CHUNK_BYTES = 1 << 20
 ALLOWED_FILE_TYPES = {"heartbeat", "trackbeat"}
 MIX_OUTPUT_FORMATS = {
     "flac": "audio/flac",
@@ -142,19 +176,121 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Chỉ dùng /dev/shm khi còn đủ chỗ trống: workdir của task /mix sống tới 1h
+# (chờ người dùng tải kết quả) và tmpfs ăn thẳng vào RAM — trên box 8GB mà
+# tmpfs cạn thì thà chậm trên đĩa còn hơn đẩy server vào OOM.
+SHM_MIN_FREE_BYTES = int(os.environ.get("SHM_MIN_FREE_BYTES", str(512 * 1024 * 1024)))
+
+
+def _shm_has_headroom() -> bool:
+    """True nếu /dev/shm tồn tại và còn ít nhất SHM_MIN_FREE_BYTES trống."""
+    try:
+        st = os.statvfs("/dev/shm")
+        return st.f_bavail * st.f_frsize >= SHM_MIN_FREE_BYTES
+    except OSError:
+        return False
+
+
+def make_temp_workdir() -> str:
+    """Tạo thư mục tạm cho một request, ưu tiên tmpfs /dev/shm nếu có.
+
+    File trung gian (upload, track tải về, WAV tiền xử lý) được đọc đi đọc lại
+    nhiều lần trong pipeline — đặt trên tmpfs biến các lần đọc đó thành thao tác
+    RAM thuần thay vì đĩa. Fallback về thư mục tạm mặc định nếu /dev/shm
+    không tồn tại (ví dụ trên macOS), không ghi được, hoặc sắp đầy.
+    """
+    if os.path.isdir("/dev/shm") and _shm_has_headroom():
+        try:
+            return tempfile.mkdtemp(prefix="woom_", dir="/dev/shm")
+        except OSError:
+            pass
+    return tempfile.mkdtemp(prefix="woom_")
+
+
+# Pool thư mục làm việc cấp sẵn: thay vì mkdtemp + rmtree mỗi request (mkdir,
+# N unlink, rmdir — nhiều metadata churn khi tải cao), tạo sẵn vài slot lúc
+# khởi động và xoay vòng chúng. Hết slot thì fallback về mkdtemp như cũ.
+WORKDIR_SLOT_COUNT = int(os.environ.get("WORKDIR_SLOT_COUNT", str(MAX_BACKGROUND_TASKS + 2)))
+_workdir_slots: "queue.Queue[str]" = queue.Queue()
+_workdir_slot_paths: set = set()
+
+
+def _init_workdir_slots() -> None:
+    """Tạo sẵn WORKDIR_SLOT_COUNT thư mục slot trong một base dir tạm."""
+    try:
+        base_dir = make_temp_workdir()
+        for i in range(WORKDIR_SLOT_COUNT):
+            slot = os.path.join(base_dir, f"slot_{i}")
+            os.makedirs(slot, exist_ok=True)
+            _workdir_slot_paths.add(slot)
+            _workdir_slots.put(slot)
+        logger.info(f"Preallocated {WORKDIR_SLOT_COUNT} workdir slots under {base_dir}")
+    except OSError as e:
+        logger.warning(f"Workdir slot pool unavailable, falling back to mkdtemp per request: {e}")
+
+
+_init_workdir_slots()
+
+
+def acquire_temp_workdir() -> str:
+    """Lấy một thư mục làm việc: ưu tiên slot cấp sẵn, hết thì mkdtemp mới."""
+    try:
+        return _workdir_slots.get_nowait()
+    except queue.Empty:
+        return make_temp_workdir()
+
+
+def _clear_dir_contents(dir_path: str) -> None:
+    """Xoá nội dung bên trong thư mục nhưng giữ lại chính thư mục đó."""
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
 def cleanup_temp(temp_dir: str):
-    """Xoá an toàn thư mục tạm sau khi xử lý xong.
+    """Dọn dẹp thư mục tạm sau khi xử lý xong.
 
-    Được gọi bới BackgroundTasks của FastAPI để dọn dẹp tài nguyên.
+    Slot cấp sẵn chỉ bị xoá nội dung rồi trả lại pool; thư mục mkdtemp
+    thường thì rmtree như cũ. Được gọi bới BackgroundTasks của FastAPI.
     Bỏ qua lỗi nếu thư mục không tồn tại hoặc đang được sử dụng.
     """
     try:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        logger.info(f"Cleaned up temporary directory: {temp_dir}")
+        if temp_dir in _workdir_slot_paths:
+            _clear_dir_contents(temp_dir)
+            _workdir_slots.put(temp_dir)
+            logger.info(f"Recycled workdir slot: {temp_dir}")
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            logger.info(f"Cleaned up temporary directory: {temp_dir}")
     except Exception as e:
         logger.error(f"Error during cleanup: {e}")
 
 
+def prefetch_file_into_page_cache(path: str) -> None:
+    """Gợi ý kernel nạp sẵn file vào page cache (posix_fadvise WILLNEED).
+
+    File vừa ghi xong sẽ được mixer đọc tuần tự ngay sau đó; readahead chạy
+    ngầm trong lúc request HTTP còn đang hoàn tất nên lần đọc sau không phải
+    chờ đĩa. No-op trên nền tảng không có posix_fadvise.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, os.path.getsize(path), os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug(f"posix_fadvise skipped for {os.path.basename(path)}: {e}")
+
+
 def save_uploadfile_to_disk(upload: UploadFile, destination_path: str) -> int:
     """Ghi nội dung UploadFile vào đĩa và trả về số byte đã ghi.
 
@@ -173,15 +309,48 @@ def save_uploadfile_to_disk(upload: UploadFile, destination_path: str) -> int:
     written = 0
     with open(destination_path, "wb") as buffer:
         while True:
-            chunk = upload.file.read(1024 * 1024)  # Đọc từng khối 1MB
+            chunk = upload.file.read(UPLOAD_COPY_CHUNK_BYTES)  # Đọc từng khối 4MB
             if not chunk:
                 break
             buffer.write(chunk)
             written += len(chunk)
 
+    if written > 0:
+        prefetch_file_into_page_cache(destination_path)
+
     return written
 
 
+class _ZipStreamBuffer:
+    """File-like writer cho zipfile, giữ bytes trong RAM để đẩy dần ra response.
+
+    ZipFile chỉ cần write/tell/flush với stream không seek được (nó tự chuyển
+    sang dùng data descriptor). Gọi drain() sau mỗi file để lấy phần bytes
+    vừa ghi và giải phóng bộ nhớ.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._offset = 0
+
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._offset += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks = []
+        return out
+
+
 def sanitize_track_name(track_name: str) -> str:
     """Làm sạch tên track để tránh tấn công path traversal.
 
@@ -601,7 +770,32 @@ def resolve_track_meta_from_head(head_data: dict, object_key: str, track_name: s
 # ---------------------------------------------------------------------------
 _tracks_cache: Dict[str, object] = {"data": None, "expires_at": 0.0}
 TRACKS_CACHE_TTL_SECONDS = 60   # Refresh at most once per minute.
-HEAD_OBJECT_WORKERS = 10        # Parallel head_object threads per listing call.
+HEAD_OBJECT_WORKERS = 10        # Parallel head_object threads for listing calls.
+
+# Pool dài hạn cho head_object, tạo một lần lúc import thay vì mỗi lần listing.
+# Tránh chi phí spawn/teardown ~10 thread mỗi lần cache hết hạn.
+HEAD_OBJECT_POOL = ThreadPoolExecutor(
+    max_workers=HEAD_OBJECT_WORKERS,
+    thread_name_prefix="r2-head",
+)
+
+
+@app.on_event("startup")
+def warmup_analysis_pipeline() -> None:
+    """Warm up librosa/FFT trong background thread lúc app start.
+
+    Lần gọi beat_track/HPSS đầu tiên tốn vài giây cho lazy import + FFT
+    plan; chạy sẵn trên silence để request /mix đầu tiên không phải chịu.
+    Thread daemon nên không chặn startup lẫn shutdown.
+    """
+    threading.Thread(target=warmup_analysis, name="analysis-warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_worker_pools() -> None:
+    """Đóng các pool module-level khi app tắt (không chờ task dở dang)."""
+    MIX_EXECUTOR.shutdown(wait=False)
+    HEAD_OBJECT_POOL.shutdown(wait=False)
 
 
 def _invalidate_tracks_cache() -> None:
@@ -781,19 +975,18 @@ def list_tracks_from_r2() -> List[Dict[str, str]]:
     t0 = time.monotonic()
 
     candidates: List[Dict] = []
-    with ThreadPoolExecutor(max_workers=min(HEAD_OBJECT_WORKERS, len(eligible))) as pool:
-        futures = {
-            pool.submit(_fetch_track_candidate, s3_client, raw_key, last_modified): raw_key
-            for raw_key, last_modified in eligible
-        }
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-            except Exception as exc:
-                logger.warning("Unexpected error in head_object worker for %s: %s", futures[future], exc)
-                result = None
-            if result is not None:
-                candidates.append(result)
+    futures = {
+        HEAD_OBJECT_POOL.submit(_fetch_track_candidate, s3_client, raw_key, last_modified): raw_key
+        for raw_key, last_modified in eligible
+    }
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as exc:
+            logger.warning("Unexpected error in head_object worker for %s: %s", futures[future], exc)
+            result = None
+        if result is not None:
+            candidates.append(result)
 
     logger.info(
         "Parallel head_object phase done: %d/%d tracks OK in %.2fs",
@@ -841,6 +1034,20 @@ def list_tracks_from_r2() -> List[Dict[str, str]]:
     return tracks
 
 
+def is_track_in_cached_listing(safe_name: str) -> Optional[bool]:
+    """Tra cứu nhanh một tên track trong cache listing R2 — không network call.
+
+    Trả về True/False khi cache còn hạn; None khi cache trống hoặc hết hạn
+    (caller phải fallback sang kiểm tra qua R2 như cũ). Lưu ý listing có lọc
+    bớt vài loại key (mixed-sound, ghost heartbeat) nên chỉ nên dùng kết quả
+    False cho các tên do frontend chọn từ chính listing này.
+    """
+    data = _tracks_cache["data"]
+    if not data or time.monotonic() >= _tracks_cache["expires_at"]:
+        return None
+    return any(t.get("track_name") == safe_name for t in data)
+
+
 def download_track_from_r2(track_name: str, temp_dir: str) -> str:
     """Download selected track from public R2 into temp directory for processing."""
     safe_name = sanitize_track_name(track_name)
@@ -857,6 +1064,7 @@ def download_track_from_r2(track_name: str, temp_dir: str) -> str:
                     logger.error(f"R2 S3 download produced empty file: {local_path}")
                     raise HTTPException(status_code=502, detail="Downloaded track is empty")
                 logger.info(f"Downloaded R2 track to temp path via S3: {local_path} (size={os.path.getsize(local_path)} bytes)")
+                prefetch_file_into_page_cache(local_path)
                 return local_path
             except ClientError as e:
                 code = str((e.response or {}).get("Error", {}).get("Code") or "")
@@ -878,7 +1086,7 @@ def download_track_from_r2(track_name: str, temp_dir: str) -> str:
         with urllib.request.urlopen(req, timeout=45) as resp, open(local_path, "wb") as out:
             total = 0
             while True:
-                chunk = resp.read(1024 * 256)
+                chunk = resp.read(R2_STREAM_CHUNK_BYTES)
                 if not chunk:
                     break
                 out.write(chunk)
@@ -899,6 +1107,7 @@ def download_track_from_r2(track_name: str, temp_dir: str) -> str:
         raise HTTPException(status_code=502, detail="Downloaded track is empty")
 
     logger.info(f"Downloaded R2 track to temp path: {local_path} (size={os.path.getsize(local_path)} bytes)")
+    prefetch_file_into_page_cache(local_path)
     return local_path
 
 
@@ -927,7 +1136,7 @@ def stream_track_from_r2(track_name: str, as_attachment: bool = False):
         try:
             with upstream as resp:
                 while True:
-                    chunk = resp.read(1024 * 256)
+                    chunk = resp.read(R2_STREAM_CHUNK_BYTES)
                     if not chunk:
                         break
                     yield chunk
@@ -1105,13 +1314,16 @@ def create_mix(
     if len(mixing_tasks) > MAX_BACKGROUND_TASKS * 2:
         cleanup_old_tasks()
 
-    # Check if we can accept more tasks
-    active_tasks = sum(1 for t in mixing_tasks.values()
-                       if t.get("status") == TASK_STATUS_PROCESSING)
-    if active_tasks >= MAX_BACKGROUND_TASKS:
+    # Từ chối tên track lạ ngay bằng cache listing (frontend chọn từ chính
+    # listing này) — khỏi tốn slot, workdir và round-trip R2 cho tên rác.
+    if is_track_in_cached_listing(sanitize_track_name(track_name)) is False:
+        raise HTTPException(status_code=404, detail=f"Track '{track_name}' not found")
+
+    # Giữ chỗ xử lý ngay tại đây (atomic) thay vì đếm dict rồi mới quyết định
+    if not MIX_TASK_SLOTS.acquire(blocking=False):
         raise HTTPException(status_code=429, detail="Too many active tasks, please retry later")
 
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = acquire_temp_workdir()
 
     try:
         # Download track from R2
@@ -1153,9 +1365,8 @@ def create_mix(
         # Create task
         task_id = create_mix_task(asset_path, picked_path, temp_dir, output_format)
 
-        # Start background thread
-        thread = threading.Thread(target=run_mix_background, args=(task_id,), daemon=True)
-        thread.start()
+        # Submit vào pool mix cố định (tối đa MAX_BACKGROUND_TASKS chạy đồng thời)
+        MIX_EXECUTOR.submit(run_mix_background, task_id)
 
         return {
             "task_id": task_id,
@@ -1165,8 +1376,13 @@ def create_mix(
         }
 
     except HTTPException:
+        # Task chưa được tạo → trả chỗ + workdir lại ngay (bình thường
+        # run_mix_background / cleanup_old_tasks đảm nhận)
+        _release_mix_slot()
+        cleanup_temp(temp_dir)
         raise
     except Exception as e:
+        _release_mix_slot()
         cleanup_temp(temp_dir)
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1280,7 +1496,7 @@ def adjust_bpm_endpoint(
     """
     logger.info(f"==========> [/adjust-bpm] NEW REQUEST STARTED. UploadFile: '{file.filename}', speeds: {speeds}")
     
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = acquire_temp_workdir()
     background_tasks.add_task(cleanup_temp, temp_dir)
 
     logger.info(f"[/adjust-bpm] Starting to write user input file to local temp disk...")
@@ -1306,25 +1522,57 @@ def adjust_bpm_endpoint(
     if file_size <= 0:
         raise HTTPException(status_code=400, detail="Uploaded file is empty")
 
-    zip_path = os.path.join(temp_dir, "bpm_adjusted.zip")
-    with zipfile.ZipFile(zip_path, "w") as zipf:
+    def stream_zip():
+        """Generator: adjust các speed rồi đẩy dần từng phần ZIP cho client.
+
+        Toàn bộ speeds được xử lý bằng MỘT lệnh ffmpeg (asplit + nhánh atempo
+        riêng, adjust_bpm_batch) — input chỉ decode một lần thay vì N lần.
+        Nếu lệnh batch thất bại, fallback gọi adjust_bpm() từng speed như cũ.
+        Dùng ZIP_STORED vì FLAC/MP3 đã nén sẵn — deflate thêm chỉ tốn CPU mà
+        không giảm kích thước.
+        """
+        plan = []  # (speed, out_name, out_path)
         for speed in speeds:
             safe = "".join(c for c in speed if c.isalnum() or c in "._-")
             if not safe:
                 continue
             out_name = f"{safe}.flac"
-            out_path = os.path.join(temp_dir, out_name)
-            try:
-                adjust_bpm(input_path, out_path, speed)
-                if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-                    zipf.write(out_path, out_name)
-                    logger.info(f"Created adjusted file for {speed}")
-                else:
-                    logger.warning(f"adjust_bpm produced no output for {speed}")
-            except Exception as e:
-                import traceback
-                logger.error(f"Error adjusting bpm ({speed}): {e}\n{traceback.format_exc()}")
-    return FileResponse(zip_path, media_type="application/zip", filename="bpm_adjusted.zip")
+            plan.append((speed, out_name, os.path.join(temp_dir, out_name)))
+
+        batch_ok = False
+        try:
+            batch_ok = adjust_bpm_batch(input_path, [(path, speed) for speed, _, path in plan])
+        except Exception as e:
+            import traceback
+            logger.error(f"Error in batched bpm adjust: {e}\n{traceback.format_exc()}")
+
+        buffer = _ZipStreamBuffer()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zipf:
+            for speed, out_name, out_path in plan:
+                try:
+                    if not batch_ok and not (os.path.exists(out_path) and os.path.getsize(out_path) > 0):
+                        adjust_bpm(input_path, out_path, speed)
+                    if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+                        zipf.write(out_path, out_name)
+                        logger.info(f"Created adjusted file for {speed}")
+                    else:
+                        logger.warning(f"adjust_bpm produced no output for {speed}")
+                except Exception as e:
+                    import traceback
+                    logger.error(f"Error adjusting bpm ({speed}): {e}\n{traceback.format_exc()}")
+                chunk = buffer.drain()
+                if chunk:
+                    yield chunk
+        # Phần central directory được ZipFile ghi nốt khi đóng
+        tail = buffer.drain()
+        if tail:
+            yield tail
+
+    return StreamingResponse(
+        stream_zip(),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="bpm_adjusted.zip"'},
+    )
 
 
 @app.get("/")
@@ -1378,12 +1626,18 @@ def cleanup_old_tasks():
             to_delete.append(task_id)
     for task_id in to_delete:
         task = mixing_tasks.get(task_id, {})
-        temp_path = task.get("output_path")
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.unlink(temp_path)
-            except Exception:
-                pass
+        # Trả lại cả workdir (slot pool hoặc mkdtemp) — output nằm bên trong
+        # nên cũng bị xoá theo. Task failed đã tự dọn thì temp_dir là None.
+        temp_dir = task.get("temp_dir")
+        if temp_dir:
+            cleanup_temp(temp_dir)
+        else:
+            temp_path = task.get("output_path")
+            if temp_path and os.path.exists(temp_path):
+                try:
+                    os.unlink(temp_path)
+                except Exception:
+                    pass
         del mixing_tasks[task_id]
     if to_delete:
         logger.info(f"Cleaned up {len(to_delete)} old tasks")
@@ -1503,7 +1757,11 @@ def run_mix_background(task_id: str):
             else:
                 logger.error(f"[task {task_id}] {label}_path={path} NOT FOUND or missing!")
 
-        from processor import preprocess_shared, calculate_duration_from_analysis, detect_tempo
+        from processor import (
+            preprocess_shared,
+            calculate_duration_from_analysis_cached,
+            detect_tempo_cached,
+        )
 
         logger.info(f"[task {task_id}] Calling preprocess_shared(asset='{asset_path}', picked='{picked_path}', dir='{temp_dir}')")
         shared_data = preprocess_shared(asset_path, picked_path, temp_dir)
@@ -1511,13 +1769,31 @@ def run_mix_background(task_id: str):
         if not shared_data.get("success"):
             raise RuntimeError(f"Preprocessing failed: {shared_data.get('error')}")
 
+        # Hai bước phân tích độc lập (heartbeat vs track) → chạy song song:
+        # đẩy detect_tempo sang thread phụ trong khi thread này phân tích heartbeat.
         update_mix_task(task_id, progress="2/7", message="Analyzing heartbeat tempo...")
-        heart_duration, heart_tempo = calculate_duration_from_analysis(
-            shared_data.get("picked_wav_mono", picked_path)
-        )
-
-        update_mix_task(task_id, progress="3/7", message="Analyzing track tempo...")
-        music_tempo = detect_tempo(shared_data.get("normalized_asset_path", asset_path))
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="tempo-analysis") as analysis_pool:
+            music_tempo_future = analysis_pool.submit(
+                detect_tempo_cached,
+                shared_data.get("normalized_asset_path", asset_path),
+                source_path=asset_path,
+            )
+            # PCM heartbeat đã decode sẵn trong preprocess_shared — phân tích
+            # trực tiếp trên array, khỏi load lại WAV từ đĩa.
+            picked_pcm = shared_data.get("picked_pcm")
+            picked_preloaded = (
+                (picked_pcm, shared_data.get("picked_sr", 0))
+                if picked_pcm is not None and shared_data.get("picked_sr")
+                else None
+            )
+            heart_duration, heart_tempo = calculate_duration_from_analysis_cached(
+                shared_data.get("picked_wav_mono", picked_path),
+                source_path=picked_path,
+                preloaded=picked_preloaded,
+            )
+
+            update_mix_task(task_id, progress="3/7", message="Analyzing track tempo...")
+            music_tempo = music_tempo_future.result()
 
         update_mix_task(task_id, progress="4/7", message="Mixing heartbeat with track...")
         from processor import mix_audio_v1
@@ -1549,15 +1825,38 @@ def run_mix_background(task_id: str):
     except Exception as e:
         import traceback
         logger.error(f"[task {task_id}] Mix failed: {e}\n{traceback.format_exc()}")
+        # Task failed không có gì để tải về → trả workdir ngay thay vì chờ
+        # cleanup_old_tasks; temp_dir=None để không bị recycle lần hai.
         update_mix_task(
             task_id,
             status=TASK_STATUS_FAILED,
             progress="7/7",
             message="Mix failed",
             error=str(e),
+            temp_dir=None,
         )
+        cleanup_temp(temp_dir)
+    finally:
+        _release_mix_slot()
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # Số worker lấy từ env (WEB_CONCURRENCY là convention chung của uvicorn/gunicorn).
+    # Mặc định 1 vì mixing_tasks là dict in-memory — nhiều worker sẽ không thấy
+    # task của nhau. Chỉ tăng khi đã chuyển task store sang Redis/DB.
+    try:
+        worker_count = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        worker_count = 1
+
+    if worker_count > 1:
+        logger.warning(
+            "Running %d uvicorn workers: /mix task polling requires a shared task store",
+            worker_count,
+        )
+        # uvicorn cần import string (không phải app object) để fork nhiều worker.
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=worker_count)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
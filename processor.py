@@ -9,13 +9,30 @@ from pydub import AudioSegment
 import numpy as np
 from scipy import signal
 import soundfile as sf
+from scipy import ndimage
+import json
 import logging
 import traceback
 import math
+import re
 import hashlib
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import aubio  # C-based streaming tempo tracker — optional, nhanh hơn librosa 5-10x
+except Exception:  # pragma: no cover - aubio là optional dependency
+    aubio = None
+
+# Cho librosa dùng pocketfft của scipy thay vì numpy.fft: nhanh hơn trên
+# STFT lớn và giữ nguyên dtype (float32 vào → complex64 ra, một nửa băng thông).
+try:
+    import scipy.fft as _scipy_fft
+    librosa.set_fftlib(_scipy_fft)
+except Exception as _fft_err:  # pragma: no cover - librosa cũ không có set_fftlib
+    logging.getLogger(__name__).warning(f"Cannot switch librosa FFT backend to scipy: {_fft_err}")
+
 def _check_lfs_pointer(path: str) -> bool:
     """Check if the file is actually a Git LFS text pointer instead of real audio."""
     try:
@@ -206,9 +223,13 @@ def _get_duration_ffprobe(path: str) -> float:
     return 0.0
 
 
-def _librosa_load_safe(audio_path: str, duration: float = 30.0):
+def _librosa_load_safe(audio_path: str, duration: float = 30.0, target_sr: int = 22050):
     """Load audio via librosa, falling back to a temp WAV conversion if the
-    file format is not recognised by libsndfile/audioread."""
+    file format is not recognised by libsndfile/audioread.
+
+    Decode mặc định ở 22050 Hz mono: beat tracking / tempo không cần băng
+    thông trên 11 kHz, nên giảm sample rate cắt ~nửa thời gian decode + STFT
+    so với giữ nguyên 44.1kHz."""
     if _check_lfs_pointer(audio_path):
         logger.error(f"❌ '{audio_path}' is a Git LFS pointer, not actual audio data! Run 'git lfs pull' on your server.")
         return np.array([]), 22050
@@ -216,7 +237,8 @@ def _librosa_load_safe(audio_path: str, duration: float = 30.0):
     import tempfile as _tempfile
     # First, try direct load
     try:
-        y, sr = librosa.load(audio_path, sr=None, duration=duration)
+        y, sr = librosa.load(audio_path, sr=target_sr, mono=True,
+                             duration=duration, dtype=np.float32)
         if len(y) > 0:
             return y, sr
     except Exception:
@@ -239,7 +261,7 @@ def _librosa_load_safe(audio_path: str, duration: float = 30.0):
             "-f wav"
         ]
         for extra in strategies:
-            cmd = f'ffmpeg -y {extra} -i "{audio_path}" -ar 44100 -ac 1 -sample_fmt s16 "{tmp_path}"'
+            cmd = f'ffmpeg -y {extra} -i "{audio_path}" -ar {int(target_sr)} -ac 1 -sample_fmt s16 "{tmp_path}"'
             # collapse multiple spaces
             cmd = ' '.join(cmd.split())
             import subprocess as _sp, shlex as _shlex
@@ -252,7 +274,8 @@ def _librosa_load_safe(audio_path: str, duration: float = 30.0):
             except Exception:
                 pass
         if converted:
-            y, sr = librosa.load(tmp_path, sr=None, duration=duration)
+            y, sr = librosa.load(tmp_path, sr=target_sr, mono=True,
+                                 duration=duration, dtype=np.float32)
             return y, sr
     finally:
         if os.path.exists(tmp_path):
@@ -263,13 +286,105 @@ def _librosa_load_safe(audio_path: str, duration: float = 30.0):
     return np.array([]), 22050
 
 
-def calculate_duration_from_analysis(picked_audio, num_beats=4):
-    """Phân tích file để lấy duration chính xác cho N nhịp tim."""
+def _normalize_amplitude(y: np.ndarray) -> np.ndarray:
+    """Peak-normalize trước khi beat tracking.
+
+    beat_track của librosa (và aubio) trả 0 lặng lẽ trên input quá nhỏ —
+    heartbeat thu điện thoại thường rất yếu nên chuẩn hoá biên độ trước.
+    """
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    peak = float(np.max(np.abs(y))) if len(y) else 0.0
+    if peak > 1e-9:
+        y = y / peak
+    return y
+
+
+def _aubio_beat_times(y: np.ndarray, sr: int):
+    """Track tempo/beats bằng aubio (C, streaming theo hop) nếu có.
+
+    Returns (bpm, beat_times_seconds) hoặc (None, None) để caller fallback
+    sang librosa.beat.beat_track.
+    """
+    if aubio is None or len(y) == 0:
+        return None, None
+    try:
+        hop = 512
+        tracker = aubio.tempo("default", 1024, hop, int(sr))
+        beats = []
+        for i in range(0, len(y) - hop + 1, hop):
+            frame = np.ascontiguousarray(y[i:i + hop], dtype=np.float32)
+            if tracker(frame)[0]:
+                beats.append(float(tracker.get_last_s()))
+        bpm = float(tracker.get_bpm())
+        if bpm <= 0:
+            return None, None
+        return bpm, beats
+    except Exception as e:
+        logger.warning(f"[aubio] Tempo tracking failed, falling back to librosa: {e}")
+        return None, None
+
+
+_BPM_RE = re.compile(r'bpm[_\-]?(\d{2,3})', re.I)
+
+
+def _bpm_from_filename(audio_path):
+    """Đọc BPM mã hoá sẵn trong tên file (vd Heartbeat5_bpm140.wav) nếu có.
+
+    File theo convention đặt tên có BPM thì khỏi tốn cả lượt load +
+    beat tracking; chỉ nhận giá trị 40–220 (khoảng hợp lý cho cả nhịp
+    tim lẫn nhạc) để không khớp nhầm số khác trong tên.
+    Returns float BPM hoặc None.
+    """
+    if not audio_path:
+        return None
+    m = _BPM_RE.search(os.path.basename(str(audio_path)))
+    if m:
+        bpm = int(m.group(1))
+        if 40 <= bpm <= 220:
+            return float(bpm)
+    return None
+
+
+def _onset_envelope(y, sr, hop_length=512):
+    """Onset envelope dùng chung cho mọi truy vấn tempo/beat trên một file.
+
+    onset_strength (mel STFT trên toàn waveform) là phần đắt nhất của cả
+    beat_track lẫn feature.tempo; tính một lần ở đây rồi các consumer chỉ
+    chạy phần rẻ (DP hoặc autocorrelation) trên envelope thay vì mỗi hàm
+    tự STFT lại từ đầu.
+    """
+    return librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+
+
+def calculate_duration_from_analysis(picked_audio, num_beats=4, preloaded=None):
+    """Phân tích file để lấy duration chính xác cho N nhịp tim.
+
+    `preloaded` (y, sr) cho phép dùng lại PCM đã decode ở bước trước
+    (preprocess_shared) thay vì load lại file từ đĩa.
+    """
+    hinted_bpm = _bpm_from_filename(picked_audio)
+    if hinted_bpm is not None:
+        logger.info(f"[analysis] BPM lấy từ tên file: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return num_beats * 60.0 / hinted_bpm, hinted_bpm
     try:
-        y, sr = _librosa_load_safe(picked_audio, duration=HEARTBEAT_ANALYSIS_SECONDS)
+        if preloaded is not None and preloaded[1]:
+            y, sr = preloaded
+            y = np.asarray(y)[: int(sr * HEARTBEAT_ANALYSIS_SECONDS)]
+        else:
+            y, sr = _librosa_load_safe(picked_audio, duration=HEARTBEAT_ANALYSIS_SECONDS)
         if len(y) == 0:
             return None, 120.0
-        tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+        y = _normalize_amplitude(y)
+
+        # Ưu tiên aubio (streaming, C) nếu cài đặt có; librosa là fallback
+        aubio_bpm, aubio_beats = _aubio_beat_times(y, sr)
+        if aubio_bpm and aubio_beats and len(aubio_beats) >= num_beats + 1:
+            duration = aubio_beats[num_beats] - aubio_beats[0]
+            if duration > 0:
+                return duration, aubio_bpm
+
+        onset_env = _onset_envelope(y, sr)
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=512)
         if hasattr(tempo, "__len__"): # Handle cases where tempo might be an array
             tempo = float(tempo[0]) if len(tempo) > 0 else 120.0
         else:
@@ -282,13 +397,36 @@ def calculate_duration_from_analysis(picked_audio, num_beats=4):
         logger.error(f"❌ Phân tích thất bại: {e}\n{traceback.format_exc()}")
     return None, 120.0
 
-def detect_tempo(audio_path):
-    """Tự detect tempo của file audio dùng Librosa."""
+def detect_tempo(audio_path, preloaded=None):
+    """Tự detect tempo của file audio dùng Librosa.
+
+    `preloaded` (y, sr) dùng lại PCM đã decode sẵn, tránh load lại từ đĩa.
+    """
+    hinted_bpm = _bpm_from_filename(audio_path)
+    if hinted_bpm is not None:
+        logger.info(f"[tempo] BPM lấy từ tên file: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return hinted_bpm
     try:
-        y, sr = _librosa_load_safe(audio_path, duration=TRACK_ANALYSIS_SECONDS)
+        if preloaded is not None and preloaded[1]:
+            y, sr = preloaded
+            y = np.asarray(y)[: int(sr * TRACK_ANALYSIS_SECONDS)]
+        else:
+            y, sr = _librosa_load_safe(audio_path, duration=TRACK_ANALYSIS_SECONDS)
         if len(y) == 0:
             return 120.0
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        y = _normalize_amplitude(y)
+
+        aubio_bpm, _aubio_beats = _aubio_beat_times(y, sr)
+        if aubio_bpm:
+            return aubio_bpm
+
+        # Chỉ cần tempo nên bỏ pass dynamic-programming dò beat của
+        # beat_track — ước lượng thẳng từ onset envelope (~30% rẻ hơn)
+        onset_env = _onset_envelope(y, sr)
+        try:
+            tempo = librosa.feature.tempo(onset_envelope=onset_env, sr=sr)
+        except AttributeError:  # librosa < 0.10
+            tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=sr)
         if hasattr(tempo, "__len__"):
             tempo = float(tempo[0]) if len(tempo) > 0 else 120.0
         else:
@@ -299,6 +437,150 @@ def detect_tempo(audio_path):
         logger.error(f"❌ Detect tempo thất bại: {e}\n{traceback.format_exc()}")
         return 120.0
 
+# ---------------------------------------------------------------------------
+# In-memory cache for tempo/beat analysis results
+# ---------------------------------------------------------------------------
+# Khoá theo digest NỘI DUNG của file NGUỒN (file tải từ R2 / upload gốc):
+# cùng một object R2 tải về nhiều lần cho ra mtime/path khác nhau nhưng nội
+# dung không đổi nên digest không đổi; hai upload khác nhau trùng tên client
+# và trùng size thì nội dung vẫn khác → không đụng độ khoá.
+_analysis_cache: dict = {}
+_ANALYSIS_CACHE_MAX_ENTRIES = 128
+
+
+def _analysis_cache_identity(path: str) -> str:
+    """Khoá cache theo nội dung: md5 của (size + 64KB đầu + 64KB cuối).
+
+    basename+size từng dùng trước đây đụng độ giữa hai upload khác nhau
+    trùng tên file client và trùng byte size — dễ xảy ra với bản ghi CBR
+    thời lượng cố định — khiến user sau nhận kết quả phân tích của user
+    trước (và sidecar còn ghim qua restart). Đọc 128KB đầu/cuối đủ phân
+    biệt nội dung mà không phải hash trọn file lớn; mtime vẫn nằm ngoài
+    khoá nên cùng object R2 tải về nhiều lần cho cùng identity.
+    Trả về chuỗi rỗng nếu không đọc được file.
+    """
+    try:
+        size = os.path.getsize(path)
+        digest = hashlib.md5(str(size).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read(65536))
+            if size > 2 * 65536:
+                f.seek(-65536, os.SEEK_END)
+                digest.update(f.read(65536))
+        return f"{digest.hexdigest()}:{size}"
+    except (OSError, TypeError, ValueError):
+        return ""
+
+
+def _analysis_sidecar_path(kind: str, identity: str) -> str:
+    """Đường dẫn file JSON lưu kết quả phân tích trong CACHE_DIR.
+
+    Track gốc nằm trên R2 (không có file cố định cạnh track để ghi sidecar),
+    nên kết quả được ghi vào thư mục cache cục bộ, khoá theo identity.
+    """
+    digest = hashlib.md5(f"{kind}:{identity}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"analysis_{digest}.json")
+
+
+def _analysis_cache_get(kind: str, identity: str):
+    if not identity:
+        return None
+    cached = _analysis_cache.get((kind, identity))
+    if cached is not None:
+        return cached
+
+    # Fallback: sidecar JSON trên đĩa (sống qua restart, khác với dict in-memory)
+    sidecar = _analysis_sidecar_path(kind, identity)
+    try:
+        if os.path.exists(sidecar):
+            with open(sidecar, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            value = payload.get("value")
+            if isinstance(value, list):
+                value = tuple(value)  # heartbeat analysis trả về tuple (duration, tempo)
+            _analysis_cache[(kind, identity)] = value
+            return value
+    except Exception as e:
+        logger.warning(f"[analysis-cache] Cannot read sidecar {os.path.basename(sidecar)}: {e}")
+    return None
+
+
+def _analysis_cache_put(kind: str, identity: str, value) -> None:
+    if not identity:
+        return
+    if len(_analysis_cache) >= _ANALYSIS_CACHE_MAX_ENTRIES:
+        # Kết quả phân tích rất nhỏ — reset toàn bộ là đủ, không cần LRU thật.
+        _analysis_cache.clear()
+    _analysis_cache[(kind, identity)] = value
+
+    # Ghi thêm sidecar JSON để các process/restart sau không phải phân tích lại
+    sidecar = _analysis_sidecar_path(kind, identity)
+    try:
+        serializable = list(value) if isinstance(value, tuple) else value
+        with open(sidecar, "w", encoding="utf-8") as f:
+            json.dump({"identity": identity, "kind": kind, "value": serializable}, f)
+    except Exception as e:
+        logger.warning(f"[analysis-cache] Cannot write sidecar {os.path.basename(sidecar)}: {e}")
+
+
+def calculate_duration_from_analysis_cached(picked_audio, num_beats=4, source_path=None, preloaded=None):
+    """Bản có cache của calculate_duration_from_analysis.
+
+    `source_path` (nếu có) là file gốc dùng làm khoá cache — ví dụ file R2
+    vừa tải về — trong khi `picked_audio` là bản WAV đã tiền xử lý.
+    """
+    hinted_bpm = _bpm_from_filename(source_path or picked_audio)
+    if hinted_bpm is not None:
+        logger.info(f"[analysis] BPM lấy từ tên file nguồn: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return num_beats * 60.0 / hinted_bpm, hinted_bpm
+    identity = _analysis_cache_identity(source_path or picked_audio)
+    cached = _analysis_cache_get(f"heartbeat:{num_beats}", identity)
+    if cached is not None:
+        logger.info(f"[analysis-cache] Hit for heartbeat analysis: {identity}")
+        return cached
+
+    result = calculate_duration_from_analysis(picked_audio, num_beats=num_beats, preloaded=preloaded)
+    # Duration None là fallback khi phân tích lỗi/decode rỗng — không ghim vào
+    # cache (nhất là sidecar sống qua restart), để lần gọi sau còn cơ hội
+    # phân tích lại thay vì biến hiccup một lần thành kết quả sai vĩnh viễn.
+    if result[0] is not None:
+        _analysis_cache_put(f"heartbeat:{num_beats}", identity, result)
+    return result
+
+
+def detect_tempo_cached(audio_path, source_path=None, preloaded=None):
+    """Bản có cache của detect_tempo, khoá theo file nguồn (xem ở trên)."""
+    hinted_bpm = _bpm_from_filename(source_path or audio_path)
+    if hinted_bpm is not None:
+        logger.info(f"[tempo] BPM lấy từ tên file nguồn: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return hinted_bpm
+    identity = _analysis_cache_identity(source_path or audio_path)
+    cached = _analysis_cache_get("tempo", identity)
+    if cached is not None:
+        logger.info(f"[analysis-cache] Hit for track tempo: {identity}")
+        return cached
+
+    tempo = detect_tempo(audio_path, preloaded=preloaded)
+    # 120.0 chẵn đúng là giá trị fallback của detect_tempo khi lỗi — bỏ qua
+    # cache cho giá trị đó (track thật hầu như không ra chẵn 120.0 tuyệt đối).
+    if tempo != 120.0:
+        _analysis_cache_put("tempo", identity, tempo)
+    return tempo
+
+
+def warmup_analysis():
+    """Chạy beat_track + HPSS trên 1 giây silence để JIT/caches của librosa,
+    numba và FFT plan được khởi tạo sẵn lúc app start, thay vì bắt request
+    /mix đầu tiên gánh vài giây compile/plan lần đầu. Best-effort: lỗi chỉ
+    log warning, không chặn startup."""
+    try:
+        y = np.zeros(22050, dtype=np.float32)
+        librosa.beat.beat_track(y=y, sr=22050)
+        _hpss_fast(y)
+        logger.info("[warmup] Analysis pipeline warmed up")
+    except Exception as e:
+        logger.warning(f"[warmup] Analysis warmup failed (non-fatal): {e}")
+
 FFMPEG_TIMEOUT = 60  # seconds – kill ffmpeg if it runs longer than this (optimized from 120s)
 INTRO_DELAY_MS = 5000
 INTRO_SECONDS = INTRO_DELAY_MS / 1000.0
@@ -314,6 +596,17 @@ MIN_PRECONVERT_ASSET_SECONDS = 1.0
 HEARTBEAT_ANALYSIS_SECONDS = 16.0
 TRACK_ANALYSIS_SECONDS = 24.0
 ANALYSIS_FFMPEG_TIMEOUT_SECONDS = 18
+# Thread flags cho các lệnh mix filter_complex nặng: -threads 0 để codec tự
+# scale theo số core, -filter_threads/-filter_complex_threads 0 cho phép
+# ffmpeg chạy song song các filter (atempo/loudnorm/amix) trên graph;
+# -thread_queue_size nới hàng đợi packet mỗi input để nhánh -stream_loop
+# không nghẽn chờ filter tiêu thụ.
+FFMPEG_MIX_THREAD_FLAGS = '-threads 0 -filter_threads 0 -filter_complex_threads 0'
+FFMPEG_INPUT_QUEUE_FLAG = '-thread_queue_size 1024'
+# Đuôi 432Hz tĩnh hoàn toàn — build một lần ở import thay vì f-string lại
+# trong từng lần dựng filter graph. asetrate đổi cả pitch lẫn speed,
+# atempo=440/432 kéo speed về; 432/440 = 0.981818...
+TUNE_432HZ_FILTER = 'asetrate=44100*432/440,aresample=44100,atempo=1.0185185185185186'
 
 HEARTBEAT_INPUT_STRATEGIES = [
     ("auto_large_probe", "-probesize 50M -analyzeduration 100M"),
@@ -366,7 +659,7 @@ def _build_optimized_mix_filter(params: dict, quality_info: dict = None) -> str:
             - fade_in_s, fade_out_start, fade_out_s
             - bpm_mode, use_loop_bed, heart_len_s, sr
             - lowpass_f (optional, default based on quality)
-            - heart_ramp_end_s, heartbeat_intro_envelope (for aloop case)
+            - heart_ramp_end_s, heartbeat_intro_envelope (for stream_loop case)
         quality_info: dict from detect_input_quality() (optional)
 
     Returns:
@@ -432,8 +725,7 @@ def _build_optimized_mix_filter(params: dict, quality_info: dict = None) -> str:
             f"volume={safe_db(params['volume_picked'])},"
             f"acompressor=threshold=-18dB:ratio={comp_ratio}:attack=8:release=100,"
             f"stereowiden=delay=5,"
-            f"afftdn=nf={safe_afftdn_nf(afftdn_nf):.1f},"
-            f"aloop=loop=-1:size={int(params.get('heart_len_s', 10) * params.get('sr', 44100))}"
+            f"afftdn=nf={safe_afftdn_nf(afftdn_nf):.1f}"
             f"[a1];"
         )
 
@@ -457,16 +749,14 @@ def _build_optimized_mix_filter(params: dict, quality_info: dict = None) -> str:
             mix_chain += f"afade=t=out:st={fade_out_start:.2f}:d={fade_out_s:.2f},"
 
         # 432Hz tuning
-        mix_chain += (
-            f"asetrate=44100*432/440,"
-            f"aresample=44100,"
-            f"atempo=1.0185185185185186,"
-        )
+        mix_chain += f"{TUNE_432HZ_FILTER},"
 
         # Limiter
         mix_chain += f"alimiter=limit=0.9[a]"
     else:
-        # Keep separate for aloop case (can't fade/432Hz infinite stream)
+        # Keep separate for stream_loop case: picked được loop bằng
+        # `-stream_loop -1` ở demuxer (decode 1 lần, buffer nhỏ) thay vì giữ
+        # toàn bộ vòng lặp trong filter aloop; fade/432Hz vẫn chạy ở bước sau.
         mix_chain = (
             f"{asset_f}{picked_f}"
             f"[a0][a1]amix=inputs=2:duration=first:dropout_transition=3"
@@ -589,10 +879,14 @@ def _plan_bpm_sync_adjustments(heart_tempo: float, music_tempo: float, max_stret
         "asset_weight": 1.0 - STANDARD_HEARTBEAT_WEIGHT,
     }
 
-def preconvert_asset(asset_audio: str, output_path: str) -> bool:
+def preconvert_asset(asset_audio: str, output_path: str, audio_filter: str = "") -> bool:
     """Try multiple FFmpeg strategies to convert an asset audio file to a
     standard 44100Hz stereo PCM WAV.
-    
+
+    `audio_filter` (nếu có) được gắn vào cùng lần decode dưới dạng -af —
+    ví dụ loudnorm — để khỏi phải thêm một round-trip WAV decode/encode
+    riêng cho bước normalize sau đó.
+
     The track files might use Wave64 (w64) format — a 64-bit extension of RIFF WAV
     that uses a GUID-based header. This explains the ffmpeg error:
         [wav] "invalid start code vers in RIFF header"
@@ -627,9 +921,10 @@ def preconvert_asset(asset_audio: str, output_path: str) -> bool:
     best_candidate = None
     best_score = -1.0
 
+    filter_part = f'-af "{audio_filter}" ' if audio_filter else ''
     for label, extra in strategies:
         candidate_path = f"{output_path}.{label}.wav"
-        cmd = f'ffmpeg -y {extra} -i "{asset_audio}" -ar 44100 -ac 2 -sample_fmt s16 "{candidate_path}"'.strip()
+        cmd = f'ffmpeg -y {extra} -i "{asset_audio}" -ar 44100 -ac 2 -sample_fmt s16 {filter_part}"{candidate_path}"'.strip()
         # Collapse double spaces that appear when extra == ""
         cmd = ' '.join(cmd.split())
         if run_ffmpeg(cmd):
@@ -709,6 +1004,47 @@ def preconvert_asset(asset_audio: str, output_path: str) -> bool:
     return False
 
 
+ASSET_NORMALIZATION_HIGH_QUALITY = os.environ.get("ASSET_NORMALIZATION_HIGH_QUALITY", "0") == "1"
+ASSET_TARGET_DBFS = -16.0
+ASSET_LOUDNORM_FILTER = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+
+
+def normalize_asset_loudness(asset_audio: str, output_path: str, high_quality: bool = None) -> bool:
+    """Chuẩn hoá âm lượng asset về ~-16 dBFS trước khi mix.
+
+    Mặc định dùng gain tĩnh: convert sang PCM (preconvert_asset), đo RMS
+    bằng numpy rồi áp MỘT lần `volume=XdB,alimiter` — đủ cho level matching
+    trước amix và rẻ hơn loudnorm (EBU R128, two-pass) cỡ một bậc.
+    Bản loudnorm đầy đủ vẫn còn sau cờ `high_quality=True` hoặc env
+    ASSET_NORMALIZATION_HIGH_QUALITY=1 khi cần loudness chính xác.
+    """
+    if high_quality is None:
+        high_quality = ASSET_NORMALIZATION_HIGH_QUALITY
+    if high_quality:
+        return preconvert_asset(asset_audio, output_path, audio_filter=ASSET_LOUDNORM_FILTER)
+
+    if not preconvert_asset(asset_audio, output_path):
+        return False
+
+    rms_dbfs = fast_mean_volume(output_path)
+    gain = ASSET_TARGET_DBFS - rms_dbfs
+    if abs(gain) < 0.5:
+        logger.info(f"[normalize_asset] Asset already at {rms_dbfs:.1f} dBFS, skipping gain pass")
+        return True
+
+    gained_path = f"{output_path}.gain.wav"
+    gain_cmd = f'ffmpeg -y -i "{output_path}" -af "volume={gain:.2f}dB,alimiter=limit=0.85" "{gained_path}"'
+    if run_ffmpeg(gain_cmd) and os.path.exists(gained_path) and os.path.getsize(gained_path) > 0:
+        os.replace(gained_path, output_path)
+        logger.info(f"[normalize_asset] Applied static gain {gain:+.1f}dB (measured {rms_dbfs:.1f} dBFS)")
+        return True
+
+    # Mixer vẫn tự cân bằng theo diff volume nên bản convert thường dùng được
+    _try_unlink(gained_path)
+    logger.warning("[normalize_asset] Gain pass failed, keeping plain converted asset")
+    return True
+
+
 def _try_unlink(path: str) -> None:
     """Silently remove a file if it exists."""
     if os.path.exists(path):
@@ -1029,6 +1365,52 @@ def _build_looped_heartbeat_bed(
     return _is_valid_decoded_audio(output_path)
 
 
+def _make_temp_dir():
+    """TemporaryDirectory ưu tiên tmpfs /dev/shm (cùng logic make_temp_workdir
+    bên main): WAV/FLAC trung gian của một lần mix nằm trọn trong RAM thay vì
+    chạm đĩa. Fallback về thư mục tạm mặc định nếu /dev/shm không có.
+    """
+    if os.path.isdir('/dev/shm'):
+        try:
+            return tempfile.TemporaryDirectory(prefix='woom_mix_', dir='/dev/shm')
+        except OSError:
+            pass
+    return tempfile.TemporaryDirectory(prefix='woom_mix_')
+
+
+def _downmix_mono(y: np.ndarray) -> np.ndarray:
+    """Downmix stereo → mono trong MỘT pass numpy.
+
+    np.mean(axis=1) cộng ra mảng tạm rồi chia — hai lượt qua toàn bộ dữ
+    liệu; với stereo chỉ cần một np.add hai cột rồi nhân 0.5 tại chỗ.
+    Kênh > 2 (hiếm) vẫn đi đường np.mean.
+    """
+    if y.ndim == 1:
+        return y
+    if y.shape[1] == 2:
+        y = np.add(y[:, 0], y[:, 1], dtype=np.float32)
+        y *= 0.5
+        return y
+    return np.mean(y, axis=1, dtype=np.float32)
+
+
+def _load_pcm_mono(wav_path: str):
+    """Decode WAV → mono float32 PCM một lần duy nhất để share giữa các stage.
+
+    float32 (thay vì float64 mặc định của soundfile) cắt nửa RAM và là dtype
+    librosa/scipy dùng nội bộ nên không còn cast ngầm ở downstream.
+    Returns (y, sr) hoặc (None, 0) nếu decode thất bại — caller tự fallback
+    về việc đọc lại file.
+    """
+    try:
+        y, sr = sf.read(wav_path, dtype='float32', always_2d=False)
+        y = _downmix_mono(y)
+        return y, sr
+    except Exception as e:
+        logger.warning(f"[preprocess_shared] PCM preload failed for {os.path.basename(wav_path)}: {e}")
+        return None, 0
+
+
 def preprocess_shared(asset_audio: str, picked_audio: str, work_dir: str):
     """Tiền xử lý chung cho pipeline v1 — chỉ chạy MỘT LẦN.
 
@@ -1044,6 +1426,8 @@ def preprocess_shared(asset_audio: str, picked_audio: str, work_dir: str):
         - 'normalized_asset_path': str – asset WAV đã loudnorm
         - 'picked_wav_stereo': str – heartbeat WAV 44100Hz stereo (cho v1)
         - 'picked_wav_mono': str – heartbeat WAV 44100Hz mono (cho HPSS)
+        - 'picked_pcm': np.ndarray | None – mono PCM đã decode sẵn (share cho mixer)
+        - 'picked_sr': int – sample rate của picked_pcm (0 nếu decode lỗi)
         - 'asset_volume': float – mean volume dBFS
         - 'error': str | None – machine-readable preprocessing error code
         - 'success': bool
@@ -1052,14 +1436,15 @@ def preprocess_shared(asset_audio: str, picked_audio: str, work_dir: str):
     """
     logger.info(f"[preprocess_shared] Starting shared preprocessing...")
 
-    raw_asset_path = os.path.join(work_dir, 'shared_asset_raw.wav')
     normalized_asset_path = os.path.join(work_dir, 'shared_asset_normalized.wav')
     picked_wav_stereo = os.path.join(work_dir, 'shared_picked_stereo.wav')
     picked_wav_mono = os.path.join(work_dir, 'shared_picked_mono.wav')
 
-    # 0) Check cache for normalized asset (skip preconvert + loudnorm if hit)
+    # 0) Check cache for normalized asset (skip preconvert + normalize if hit).
+    # Tag cache theo mode normalize — output gain tĩnh và loudnorm khác nhau.
+    asset_norm_tag = "loudnorm" if ASSET_NORMALIZATION_HIGH_QUALITY else "gainnorm"
     if os.path.exists(asset_audio):
-        asset_cache_key = _get_cache_key(asset_audio, "loudnorm")
+        asset_cache_key = _get_cache_key(asset_audio, asset_norm_tag)
         cached_asset = _check_cache(asset_cache_key)
         if cached_asset:
             logger.info(f"[preprocess_shared] Cache hit for normalized asset: {os.path.basename(cached_asset)}")
@@ -1075,51 +1460,67 @@ def preprocess_shared(asset_audio: str, picked_audio: str, work_dir: str):
                 return {'success': False, 'error': 'heartbeat-decode-failed'}
             if not heartbeat_ready:
                 _cache_heartbeat_variants(picked_audio, picked_wav_stereo, picked_wav_mono)
+            picked_pcm, picked_sr = _load_pcm_mono(picked_wav_mono)
             logger.info(f"[preprocess_shared] Done (from cache). asset_vol={asset_volume:.1f}dB")
             return {
                 'success': True,
                 'normalized_asset_path': normalized_asset_path,
                 'picked_wav_stereo': picked_wav_stereo,
                 'picked_wav_mono': picked_wav_mono,
+                'picked_pcm': picked_pcm,
+                'picked_sr': picked_sr,
                 'asset_volume': asset_volume,
             }
 
-    # 1) Pre-convert asset (worst case tries 7 strategies — but only ONCE)
-    if not preconvert_asset(asset_audio, raw_asset_path):
-        logger.error(f"[preprocess_shared] Cannot decode asset audio '{asset_audio}'")
-        return {'success': False, 'error': 'asset-decode-failed'}
-
-    # 2) Loudnorm asset → chuẩn -16 LUFS
-    if not run_ffmpeg(
-        f'ffmpeg -y -i "{raw_asset_path}" -ar 44100 -ac 2 '
-        f'-af loudnorm=I=-16:TP=-1.5:LRA=11 "{normalized_asset_path}"'
-    ):
-        logger.error("[preprocess_shared] Asset loudnorm failed")
-        return {'success': False, 'error': 'asset-loudnorm-failed'}
-    _try_unlink(raw_asset_path)  # free disk space early
-
-    # Save to cache
-    if os.path.exists(asset_audio):
-        asset_cache_key = _get_cache_key(asset_audio, "loudnorm")
-        _save_to_cache(asset_cache_key, normalized_asset_path)
-        logger.info(f"[preprocess_shared] Saved normalized asset to cache")
-
-    # 3) Convert picked → WAV stereo và mono, có fallback demuxer.
-    heartbeat_ready = _restore_cached_heartbeat_variants(
-        picked_audio,
-        picked_wav_stereo,
-        picked_wav_mono,
-    )
-    if not heartbeat_ready and not _ffmpeg_convert_heartbeat_variants(picked_audio, picked_wav_stereo, picked_wav_mono):
-        logger.error(f"[preprocess_shared] Cannot decode heartbeat upload '{picked_audio}'")
-        return {'success': False, 'error': 'heartbeat-decode-failed'}
-
-    if not heartbeat_ready:
-        _cache_heartbeat_variants(picked_audio, picked_wav_stereo, picked_wav_mono)
+    # 1+2) Asset leg: preconvert → loudnorm → cache. Chạy SONG SONG với leg
+    # heartbeat bên dưới — hai leg không phụ thuộc dữ liệu nhau cho tới amix,
+    # và FFmpeg là subprocess (nhả GIL) nên chồng lên nhau ăn trọn 2 core.
+    def _prepare_asset_leg():
+        """Trả về error code (str) hoặc None nếu thành công."""
+        # Mặc định: gain tĩnh đo bằng numpy (rẻ); loudnorm đầy đủ khi bật
+        # ASSET_NORMALIZATION_HIGH_QUALITY (xem normalize_asset_loudness).
+        if not normalize_asset_loudness(asset_audio, normalized_asset_path):
+            logger.error(f"[preprocess_shared] Cannot decode asset audio '{asset_audio}'")
+            return 'asset-decode-failed'
+
+        # Save to cache
+        if os.path.exists(asset_audio):
+            asset_cache_key = _get_cache_key(asset_audio, asset_norm_tag)
+            _save_to_cache(asset_cache_key, normalized_asset_path)
+            logger.info(f"[preprocess_shared] Saved normalized asset to cache")
+        return None
+
+    # 3) Picked leg: convert heartbeat → WAV stereo và mono, có fallback demuxer.
+    def _prepare_picked_leg():
+        """Trả về error code (str) hoặc None nếu thành công."""
+        heartbeat_ready = _restore_cached_heartbeat_variants(
+            picked_audio,
+            picked_wav_stereo,
+            picked_wav_mono,
+        )
+        if not heartbeat_ready and not _ffmpeg_convert_heartbeat_variants(picked_audio, picked_wav_stereo, picked_wav_mono):
+            logger.error(f"[preprocess_shared] Cannot decode heartbeat upload '{picked_audio}'")
+            return 'heartbeat-decode-failed'
+        if not heartbeat_ready:
+            _cache_heartbeat_variants(picked_audio, picked_wav_stereo, picked_wav_mono)
+        return None
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="preprocess-asset") as leg_pool:
+        asset_future = leg_pool.submit(_prepare_asset_leg)
+        picked_error = _prepare_picked_leg()  # leg heartbeat chạy luôn trên thread hiện tại
+        asset_error = asset_future.result()
+
+    if asset_error:
+        return {'success': False, 'error': asset_error}
+    if picked_error:
+        return {'success': False, 'error': picked_error}
 
     # 4) Đo volume asset bằng numpy (0 subprocess)
     asset_volume = fast_mean_volume(normalized_asset_path)
 
+    # 5) Decode PCM mono một lần để mixer dùng lại, khỏi sf.read lần hai
+    picked_pcm, picked_sr = _load_pcm_mono(picked_wav_mono)
+
     logger.info(
         f"[preprocess_shared] Done. asset_vol={asset_volume:.1f}dB"
     )
@@ -1129,6 +1530,8 @@ def preprocess_shared(asset_audio: str, picked_audio: str, work_dir: str):
         'normalized_asset_path': normalized_asset_path,
         'picked_wav_stereo': picked_wav_stereo,
         'picked_wav_mono': picked_wav_mono,
+        'picked_pcm': picked_pcm,
+        'picked_sr': picked_sr,
         'asset_volume': asset_volume,
     }
 
@@ -1142,9 +1545,16 @@ def run_ffmpeg(command, timeout=FFMPEG_TIMEOUT):
     """
     logger.info(f"Running ffmpeg command: {command}")
     cmd_list = shlex.split(command)
-    # Thêm -nostdin nếu là ffmpeg command (chặn ffmpeg đọc stdin hoàn toàn)
-    if cmd_list and cmd_list[0].endswith('ffmpeg') and '-nostdin' not in cmd_list:
-        cmd_list.insert(1, '-nostdin')
+    # Thêm -nostdin (chặn ffmpeg đọc stdin) + tắt banner/progress stats:
+    # stderr đi qua PIPE bị buffer toàn bộ vào RAM rồi decode dù lệnh thành
+    # công — loglevel error giữ stderr gần như rỗng trên happy path nhưng
+    # vẫn đầy đủ chi tiết khi returncode != 0.
+    if cmd_list and cmd_list[0].endswith('ffmpeg'):
+        if '-loglevel' not in cmd_list:
+            cmd_list[1:1] = ['-loglevel', 'error']
+        for flag in ('-nostats', '-hide_banner', '-nostdin'):
+            if flag not in cmd_list:
+                cmd_list.insert(1, flag)
     process = None
     try:
         logger.info(f"[run_ffmpeg] Spawning process...")
@@ -1178,17 +1588,8 @@ def run_ffmpeg(command, timeout=FFMPEG_TIMEOUT):
         return False
 
 
-def adjust_bpm(input_path, output_path, speed_mode):
-    """Adjust playback speed of an audio file using FFmpeg's atempo filter.
-
-    The `speed_mode` may be one of the named presets or a numeric factor (as
-    a string). Presets are:
-        * "Slow"  -> 0.8
-        * "Normal" -> 1.0
-        * "Fast"  -> 1.2
-
-    Any other value will be parsed as a float and clipped to a sane range.
-    """
+def _resolve_speed_factor(speed_mode) -> float:
+    """Đổi speed_mode (preset hoặc chuỗi số) thành hệ số atempo đã clamp."""
     speed_map = {
         'Slow': 0.8,
         'Normal': 1.0,
@@ -1206,7 +1607,59 @@ def adjust_bpm(input_path, output_path, speed_mode):
     # FFmpeg decide internally.)
     if speed <= 0 or speed is None or isinstance(speed, complex):
         speed = 1.0
-    speed = max(0.5, min(100.0, speed))
+    return max(0.5, min(100.0, speed))
+
+
+def adjust_bpm_batch(input_path, outputs) -> bool:
+    """Tạo nhiều phiên bản tốc độ từ MỘT lần decode input duy nhất.
+
+    `outputs` là list các cặp (output_path, speed_mode). Một lệnh ffmpeg với
+    asplit + nhánh atempo riêng cho từng speed ghi thẳng ra N output — tiết
+    kiệm (N-1) lần decode input so với gọi adjust_bpm() trong vòng lặp.
+
+    Returns True nếu toàn bộ output được ghi; False để caller fallback
+    per-speed qua adjust_bpm().
+    """
+    if not outputs:
+        return True
+    if len(outputs) == 1:
+        adjust_bpm(input_path, outputs[0][0], outputs[0][1])
+        return os.path.exists(outputs[0][0]) and os.path.getsize(outputs[0][0]) > 0
+
+    n = len(outputs)
+    split_labels = ''.join(f'[s{i}]' for i in range(n))
+    branches = [f'[0:a]asplit={n}{split_labels}']
+    maps = []
+    for i, (output_path, speed_mode) in enumerate(outputs):
+        speed = _resolve_speed_factor(speed_mode)
+        branches.append(f'[s{i}]{get_atempo_filter(speed)}[o{i}]')
+        maps.append(f'-map "[o{i}]" {codec_args(output_path)} "{output_path}"')
+        logger.info(f"Adjusting BPM (batch): Mode='{speed_mode}', Factor={speed}, Output={output_path}")
+
+    cmd = (
+        f'ffmpeg -y {FFMPEG_MIX_THREAD_FLAGS} {FFMPEG_INPUT_QUEUE_FLAG} -i "{input_path}" '
+        f'-filter_complex "{"; ".join(branches)}" '
+        f'{" ".join(maps)}'
+    )
+    if not run_ffmpeg(cmd):
+        logger.warning("[adjust_bpm_batch] Batched ffmpeg failed, caller should fallback per-speed")
+        return False
+
+    return all(os.path.exists(p) and os.path.getsize(p) > 0 for p, _ in outputs)
+
+
+def adjust_bpm(input_path, output_path, speed_mode):
+    """Adjust playback speed of an audio file using FFmpeg's atempo filter.
+
+    The `speed_mode` may be one of the named presets or a numeric factor (as
+    a string). Presets are:
+        * "Slow"  -> 0.8
+        * "Normal" -> 1.0
+        * "Fast"  -> 1.2
+
+    Any other value will be parsed as a float and clipped to a sane range.
+    """
+    speed = _resolve_speed_factor(speed_mode)
 
     logger.info(f"Adjusting BPM: Mode='{speed_mode}', Factor={speed}, Output={output_path}")
     # select codec based on output extension
@@ -1222,6 +1675,33 @@ def adjust_bpm(input_path, output_path, speed_mode):
         # copy through if atempo fails
         run_ffmpeg(f'ffmpeg -y -i "{input_path}"{codec} "{output_path}"')
 
+def _hpss_fast(y: np.ndarray):
+    """HPSS rút gọn: STFT float32/complex64 + median filter của scipy.ndimage.
+
+    librosa.effects.hpss chạy toàn bộ ở complex128; pipeline này chỉ cần mask
+    Wiener mềm nên làm trực tiếp trên complex64 nhanh gấp ~2 lần và tốn một
+    nửa RAM. Median ngang trục thời gian làm nổi harmonic, dọc trục tần số
+    làm nổi percussive (đúng quy ước của librosa.decompose.hpss).
+
+    Returns (y_harmonic, y_percussive); fallback librosa.effects.hpss nếu lỗi.
+    """
+    try:
+        y32 = np.ascontiguousarray(y, dtype=np.float32)
+        D = librosa.stft(y32, n_fft=2048, hop_length=512).astype(np.complex64, copy=False)
+        mag = np.abs(D)
+        harm = ndimage.median_filter(mag, size=(1, 31))
+        perc = ndimage.median_filter(mag, size=(31, 1))
+        harm2 = harm * harm
+        perc2 = perc * perc
+        denom = harm2 + perc2 + np.float32(1e-9)
+        y_h = librosa.istft(D * (harm2 / denom), hop_length=512, length=len(y32))
+        y_p = librosa.istft(D * (perc2 / denom), hop_length=512, length=len(y32))
+        return y_h, y_p
+    except Exception as e:
+        logger.warning(f"[HPSS] Fast median-filter path failed ({e}), falling back to librosa.effects.hpss")
+        return librosa.effects.hpss(y)
+
+
 def apply_noise_reduction(y, sr, denoise_level='auto', quality_info=None):
     """Adaptive HPSS: blend harmonic + percussive based on file quality.
 
@@ -1234,7 +1714,7 @@ def apply_noise_reduction(y, sr, denoise_level='auto', quality_info=None):
     Returns:
         numpy array đã xử lý
     """
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
+    y_harmonic, y_percussive = _hpss_fast(y)
 
     if denoise_level == 'none':
         return y
@@ -1280,8 +1760,11 @@ def detect_input_quality(y: np.ndarray, sr: int) -> dict:
             'harmonic_ratio': 1.0
         }
 
+    # float32 cho mọi phép STFT/RMS phía dưới (complex64 thay vì complex128)
+    y = np.ascontiguousarray(y, dtype=np.float32)
+
     # HPSS decomposition
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
+    y_harmonic, y_percussive = _hpss_fast(y)
 
     # Tính energy
     harm_energy = float(np.mean(y_harmonic ** 2))
@@ -1329,18 +1812,45 @@ def codec_args(output_path: str):
     else:
         return '-c:a libmp3lame -q:a 2'
 
+@functools.lru_cache(maxsize=1)
+def _ffmpeg_has_rubberband() -> bool:
+    """True nếu build FFmpeg hiện tại có filter rubberband (librubberband).
+
+    Chỉ probe `ffmpeg -filters` một lần mỗi process (lru_cache)."""
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-filters'],
+            capture_output=True, text=True, timeout=10,
+        )
+        return 'rubberband' in result.stdout
+    except Exception as e:
+        logger.debug(f"[ffmpeg] Filter probe failed: {e}")
+        return False
+
+
 def tune_to_432hz(input_path, output_path):
     """Pitch shift toàn bộ audio xuống 432Hz tuning từ 440Hz dùng FFmpeg."""
-    # asetrate changes pitch and speed, atempo corrects the speed back.
-    # 432/440 = 0.981818... and 440/432 = 1.018518...
-    # Pre-calculate asetrate value to avoid potential issues with expressions in some ffmpeg builds
-    asetrate_val = int(44100 * 432 / 440)  # ~43209
+    # rubberband shift pitch trong MỘT stage (không resample 2 lần như chuỗi
+    # asetrate→aresample→atempo) nên nhanh hơn và ít artifact hơn — nhưng chỉ
+    # có trên build FFmpeg compile với librubberband, nên probe trước.
+    if _ffmpeg_has_rubberband():
+        cmd = (
+            f'ffmpeg -y -i "{input_path}" '
+            f'-af "rubberband=pitch=0.9818181818181818" '
+            f'{codec_args(output_path)} "{output_path}"'
+        )
+        logger.info(f"[tune_to_432hz] input={input_path}, output={output_path}, filter=rubberband")
+        if run_ffmpeg(cmd) and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            logger.info(f"[tune_to_432hz] Success: {output_path} (size={os.path.getsize(output_path)})")
+            return True
+        logger.warning("[tune_to_432hz] rubberband failed, falling back to asetrate chain")
+
     cmd = (
         f'ffmpeg -y -i "{input_path}" '
-        f'-af "asetrate={asetrate_val},aresample=44100,atempo=1.0185185185185186" '
+        f'-af "{TUNE_432HZ_FILTER}" '
         f'{codec_args(output_path)} "{output_path}"'
     )
-    logger.info(f"[tune_to_432hz] input={input_path}, output={output_path}, asetrate={asetrate_val}")
+    logger.info(f"[tune_to_432hz] input={input_path}, output={output_path}, filter=asetrate chain")
     result = run_ffmpeg(cmd)
     if result:
         logger.info(f"[tune_to_432hz] Success: {output_path} (size={os.path.getsize(output_path) if os.path.exists(output_path) else 'N/A'})")
@@ -1349,17 +1859,21 @@ def tune_to_432hz(input_path, output_path):
     return result
 
 def get_atempo_filter(rate):
-    """Helper to generate atempo filter string, chaining if rate is outside [0.5, 100]."""
-    if rate <= 0: return "atempo=1.0"
-    filters = []
-    while rate < 0.5:
-        filters.append("atempo=0.5")
-        rate /= 0.5
-    while rate > 100.0:
-        filters.append("atempo=100.0")
-        rate /= 100.0
-    filters.append(f"atempo={rate}")
-    return ",".join(filters)
+    """Sinh chuỗi atempo, chia đều thành nhiều stage khi rate ngoài [0.5, 2.0].
+
+    Mỗi instance atempo chỉ đảm bảo chất lượng trong 0.5–2.0 (build cũ còn
+    clamp cứng ở đó). Thay vì dồn hết phần dư vào stage cuối, chia rate
+    thành n = ceil(|log2(rate)|) stage TỶ LỆ BẰNG NHAU — mỗi stage càng
+    gần 1.0 thì thuật toán SOLA overlap càng sạch và càng ít phải đi
+    đường cascade nội bộ chậm của filter.
+    """
+    if rate <= 0:
+        return "atempo=1.0"
+    if 0.5 <= rate <= 2.0:
+        return f"atempo={rate}"
+    n = max(1, math.ceil(abs(math.log2(rate))))
+    stage = rate ** (1.0 / n)
+    return ",".join(f"atempo={stage:.10f}" for _ in range(n))
 
 def time_stretch_heartbeat(input_path, output_path, target_tempo, original_tempo):
     """Stretch nhịp tim dùng FFmpeg atempo."""
@@ -1587,7 +2101,7 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
         music_tempo = 120.0
 
     logger.info(f"[mix] Starting mix_audio: heart={heart_tempo:.0f}BPM, music={music_tempo:.0f}BPM")
-    temp_dir_obj = tempfile.TemporaryDirectory()
+    temp_dir_obj = _make_temp_dir()
     temp_dir = temp_dir_obj.name
     try:
         denoised_path       = os.path.join(temp_dir, 'picked_denoised.wav')
@@ -1635,16 +2149,10 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
                         "Cannot decode heartbeat upload. Please re-export as PCM WAV, FLAC, or MP3 and try again."
                     )
 
-                raw_asset_path = os.path.join(temp_dir, 'asset_raw.wav')
-                if not preconvert_asset(asset_audio, raw_asset_path):
+                # Gain tĩnh mặc định, loudnorm khi high-quality (xem normalize_asset_loudness)
+                if not normalize_asset_loudness(asset_audio, normalized_asset_path):
                     raise RuntimeError("Cannot decode background track audio for mixing.")
 
-                if not run_ffmpeg(
-                    f'ffmpeg -y -i "{raw_asset_path}" -ar 44100 -ac 2 '
-                    f'-af loudnorm=I=-16:TP=-1.5:LRA=11 "{normalized_asset_path}"'
-                ):
-                    raise RuntimeError("Failed to normalize background track audio for mixing.")
-
                 # Save to cache and log details
                 if os.path.exists(asset_audio):
                     asset_cache_key = _get_cache_key(asset_audio)
@@ -1666,10 +2174,15 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
                 logger.debug(f"[cache] Cache size check failed: {e}")
 
         # ── 2. HPSS denoising ────────────────────────────────────────────────
-        y, sr = sf.read(temp_wav_path)
-        if y.ndim > 1:
-            y = np.mean(y, axis=1)
-        logger.info(f"[mix] Audio loaded: {len(y)/sr:.1f}s @ {sr}Hz")
+        # Dùng lại PCM đã decode trong preprocess_shared nếu có, tránh sf.read lần hai
+        shared_pcm = shared_data.get('picked_pcm') if use_shared else None
+        if shared_pcm is not None and shared_data.get('picked_sr', 0) > 0:
+            y, sr = shared_pcm, shared_data['picked_sr']
+            logger.info(f"[mix] Reusing preloaded PCM: {len(y)/sr:.1f}s @ {sr}Hz")
+        else:
+            y, sr = sf.read(temp_wav_path, dtype='float32', always_2d=False)
+            y = _downmix_mono(y)
+            logger.info(f"[mix] Audio loaded: {len(y)/sr:.1f}s @ {sr}Hz")
  
 
         # Auto-detect input quality
@@ -1681,7 +2194,8 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
  
         # ── 3. Chọn đoạn heartbeat ổn định nhất ~10s ────────────────────────
         y_stable = extract_stable_heartbeat_segment(y_denoised, sr, target_duration=10.0, quality_info=quality_info)
-        sf.write(stable_path, y_stable, sr)
+        # PCM_16 là đủ cho WAV trung gian (đích cuối là MP3) — nửa dung lượng I/O
+        sf.write(stable_path, y_stable, sr, subtype='PCM_16')
         stable_dur = len(y_stable) / sr
         logger.info(f"[mix] Stable segment extracted: {stable_dur:.1f}s → {stable_path}")
  
@@ -1737,18 +2251,27 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
         else:
             stretched_asset_for_mix = normalized_asset_path
  
-        # ── 5. Normalize heartbeat ───────────────────────────────────────────
-        picked_seg = AudioSegment.from_file(stretched_path, format='wav').normalize()
+        # ── 5. Normalize heartbeat (numpy in-place, không qua PyDub) ─────────
+        # y_stable vẫn còn trong RAM — peak-normalize trực tiếp trên array thay
+        # vì để AudioSegment decode lại stretched_path rồi export lần nữa.
+        y_heart = np.ascontiguousarray(y_stable, dtype=np.float32)
+        peak = float(np.max(np.abs(y_heart))) if len(y_heart) else 0.0
+        if peak > 1e-9:
+            y_heart *= 0.999 / peak
+        rms = float(np.sqrt(np.mean(np.square(y_heart)))) if len(y_heart) else 0.0
+        heart_dbfs = 20.0 * math.log10(rms + 1e-12)
         # RMS boost nếu signal sparse (HPSS percussive)
         target_rms_dbfs = -16.0 if bpm_mode == "ambient-texture" else -12.0
-        if picked_seg.dBFS < target_rms_dbfs:
+        if heart_dbfs < target_rms_dbfs:
             boost_cap = 12.0 if bpm_mode == "ambient-texture" else 18.0
-            boost = min(target_rms_dbfs - picked_seg.dBFS, boost_cap)
-            picked_seg = picked_seg + boost
+            boost = min(target_rms_dbfs - heart_dbfs, boost_cap)
+            y_heart *= 10.0 ** (boost / 20.0)
+            np.clip(y_heart, -1.0, 1.0, out=y_heart)
+            heart_dbfs += boost
             logger.info(f"[mix] RMS boost: +{boost:.1f}dB")
-        picked_seg.export(normalized_picked_path, format="wav")
-        heart_len_s = len(picked_seg) / 1000.0
-        logger.info(f"[mix] Normalized heartbeat: {heart_len_s:.1f}s, dBFS={picked_seg.dBFS:.1f}")
+        sf.write(normalized_picked_path, y_heart, sr, subtype='PCM_16')
+        heart_len_s = len(y_heart) / sr
+        logger.info(f"[mix] Normalized heartbeat: {heart_len_s:.1f}s, dBFS={heart_dbfs:.1f}")
  
         # ── 6. Volume balance ─────────────────────────────────────────────────
         vol_picked = fast_mean_volume(normalized_picked_path)
@@ -1820,9 +2343,14 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
         mix_filter = _build_optimized_mix_filter(mix_params, quality_info)
 
         enc = codec_args(mixed_temp_path)
-        picked_mix_input_flag = f'"{picked_mix_input_path}"'
+        if loop_bed_ready:
+            picked_mix_input_flag = f'{FFMPEG_INPUT_QUEUE_FLAG} -i "{picked_mix_input_path}"'
+        else:
+            # Loop heartbeat ở demuxer thay vì filter aloop: decode đúng một
+            # lần, không buffer nguyên vòng lặp PCM trong RAM của filter graph.
+            picked_mix_input_flag = f'-stream_loop -1 {FFMPEG_INPUT_QUEUE_FLAG} -i "{picked_mix_input_path}"'
         primary_mix_ok = run_ffmpeg(
-            f'ffmpeg -y -i "{stretched_asset_for_mix}" -i {picked_mix_input_flag} '
+            f'ffmpeg -y {FFMPEG_MIX_THREAD_FLAGS} {FFMPEG_INPUT_QUEUE_FLAG} -i "{stretched_asset_for_mix}" {picked_mix_input_flag} '
             f'-filter_complex "{mix_filter}" -map "[a]" {enc} "{mixed_temp_path}"'
         )
         if primary_mix_ok:
@@ -1884,8 +2412,7 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
                     f"volume='{heartbeat_intro_envelope}':eval=frame,"
                     f"volume={safe_db(max(0, diff) + (1 if bpm_mode == 'ambient-texture' else 3))}dB,"
                     f"acompressor=threshold=-20dB:ratio=1.4:attack=10:release=120,"
-                    f"afftdn=nf={safe_afftdn_nf(-24.0):.1f},"
-                    f"aloop=loop=-1:size={int(heart_len_s * sr)}"
+                    f"afftdn=nf={safe_afftdn_nf(-24.0):.1f}"
                     f"[a1];"
                 )
             fallback_mix_filter = (
@@ -1895,9 +2422,10 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
                 f"alimiter=limit=0.9"
                 f"[a]"
             )
-            fallback_input_flag = picked_mix_input_flag if loop_bed_ready else f'-i "{normalized_picked_path}"'
+            # picked_mix_input_flag đã gồm -stream_loop -1 cho case không có loop bed
+            fallback_input_flag = picked_mix_input_flag
             primary_mix_ok = run_ffmpeg(
-                f'ffmpeg -y -i "{stretched_asset_for_mix}" {fallback_input_flag} '
+                f'ffmpeg -y {FFMPEG_MIX_THREAD_FLAGS} {FFMPEG_INPUT_QUEUE_FLAG} -i "{stretched_asset_for_mix}" {fallback_input_flag} '
                 f'-filter_complex "{fallback_mix_filter}" -map "[a]" {enc} "{mixed_temp_path}"'
             )
 
@@ -1972,9 +2500,9 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
                     f"alimiter=limit=0.92"
                     f"[a]"
                 )
-            fallback_input_flag = picked_mix_input_flag if loop_bed_ready else f'-stream_loop -1 -i "{normalized_picked_path}"'
+            fallback_input_flag = picked_mix_input_flag
             fallback_ok = run_ffmpeg(
-                f'ffmpeg -y -i "{stretched_asset_for_mix}" {fallback_input_flag} '
+                f'ffmpeg -y {FFMPEG_MIX_THREAD_FLAGS} {FFMPEG_INPUT_QUEUE_FLAG} -i "{stretched_asset_for_mix}" {fallback_input_flag} '
                 f'-filter_complex "{fallback_filter}" -map "[a]" '
                 f'-c:a flac -compression_level 5 "{fallback_mixed_path}"'
             )
@@ -2106,3 +2634,43 @@ def mix_audio_v1(asset_audio, picked_audio, output_path, original_bpm=120, targe
         temp_dir_obj.cleanup()
  
 
+
+
+def _mix_one(pair):
+    """Wrapper top-level (picklable) cho một job mix trong process pool.
+
+    Returns (output_path, error_message | None).
+    """
+    asset_audio, picked_audio, output_path = pair
+    try:
+        mix_audio_v1(asset_audio, picked_audio, output_path)
+        return output_path, None
+    except Exception as e:
+        return output_path, str(e)
+
+
+def mix_audio_batch(pairs, max_workers=None):
+    """Mix nhiều cặp (asset, picked, output) song song bằng process pool.
+
+    Dành cho batch offline (CLI/script) — API dùng thread worker vì cần share
+    mixing_tasks in-memory. Mỗi job gồm cả FFmpeg subprocess lẫn librosa nên
+    process pool cho scale tuyến tính theo core; mặc định ncpu/2 worker vì
+    bản thân FFmpeg cũng đa luồng, oversubscribe quá mức sẽ phản tác dụng.
+
+    Returns list[(output_path, error | None)] theo đúng thứ tự `pairs`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 2) // 2)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(_mix_one, pairs))
+
+    failed = [p for p, err in results if err]
+    if failed:
+        logger.warning(f"[mix_audio_batch] {len(failed)}/{len(results)} jobs failed: {failed}")
+    return results
